@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+共享客户端模块
+功能：统一加载配置，并为Supabase和OpenAI提供共享的、带连接池的HTTP传输层
+作者：AI Assistant
+"""
+
+import os
+import logging
+import threading
+from functools import partial
+from typing import Callable, Dict, List, Optional, Tuple
+
+# 第三方库导入
+import httpx
+from openai import OpenAI
+from supabase import create_client, Client, ClientOptions
+
+logger = logging.getLogger(__name__)
+
+# 主题字段向量和查询向量共用的嵌入模型
+EMBEDDING_MODEL = 'text-embedding-3-small'
+EMBEDDING_MAX_TOKENS = 8191  # 嵌入模型单条输入的token上限
+
+
+def _http2_available() -> bool:
+    """检查是否安装了HTTP/2支持（h2包）"""
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def load_client_settings(require_supabase: bool = True) -> Dict[str, Optional[str]]:
+    """加载Supabase和OpenAI配置
+
+    优先从环境变量获取配置，如果存在config.py则以config.py中的配置为准。
+    只使用OpenAI的服务（如查询向量服务）可传入require_supabase=False。
+    """
+    settings = {
+        'supabase_url': os.getenv('SUPABASE_URL'),
+        'supabase_key': os.getenv('SUPABASE_SERVICE_ROLE_KEY'),  # 使用SERVICE_ROLE_KEY
+        'openai_api_key': os.getenv('OPENAI_API_KEY'),
+        'openai_base_url': os.getenv('OPENAI_BASE_URL'),
+    }
+
+    # 尝试从config.py导入配置（优先使用config.py中的配置）
+    try:
+        import config
+        settings['supabase_url'] = config.SUPABASE_URL
+        settings['supabase_key'] = getattr(config, 'SUPABASE_SERVICE_ROLE_KEY', config.SUPABASE_ANON_KEY)
+        settings['openai_api_key'] = config.OPENAI_API_KEY
+        # 检查是否有自定义的OpenAI Base URL
+        if hasattr(config, 'OPENAI_BASE_URL'):
+            settings['openai_base_url'] = config.OPENAI_BASE_URL
+        logger.info("从config.py文件加载配置")
+    except ImportError:
+        logger.info("config.py不存在，使用环境变量")
+
+    if not settings['openai_api_key']:
+        raise ValueError("请设置环境变量或在config.py中配置：OPENAI_API_KEY")
+    if require_supabase and not all([settings['supabase_url'], settings['supabase_key']]):
+        raise ValueError("请设置环境变量或在config.py中配置：SUPABASE_URL, SUPABASE_SERVICE_ROLE_KEY")
+
+    return settings
+
+
+class _TrackedStream(httpx.SyncByteStream):
+    """响应体关闭时通知请求已结束"""
+
+    def __init__(self, stream: httpx.SyncByteStream, on_close: Callable[[], None]):
+        self._stream = stream
+        self._on_close = on_close
+        self._closed = False
+
+    def __iter__(self):
+        yield from self._stream
+
+    def close(self):
+        try:
+            self._stream.close()
+        finally:
+            if not self._closed:
+                self._closed = True
+                self._on_close()
+
+
+class _InflightTransport(httpx.BaseTransport):
+    """包装httpx传输层，统计连接池上正在进行的请求数（从发出请求到响应体关闭）"""
+
+    def __init__(self, transport: httpx.BaseTransport, on_finish: Callable[[], None]):
+        self._transport = transport
+        self._on_finish = on_finish
+        self._lock = threading.Lock()
+        self.inflight = 0
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        with self._lock:
+            self.inflight += 1
+        try:
+            response = self._transport.handle_request(request)
+        except BaseException:
+            self._finish()
+            raise
+        response.stream = _TrackedStream(response.stream, self._finish)
+        return response
+
+    def close(self):
+        self._transport.close()
+
+    def _finish(self):
+        with self._lock:
+            self.inflight -= 1
+        self._on_finish()
+
+
+class HttpTransport:
+    """共享HTTP传输层
+
+    每个服务（supabase / openai）使用一个独立的长连接池，聊天、向量和数据库请求
+    复用同一套keep-alive与连接数限制。某个服务出现网络错误时，只重建该服务的连接池；
+    旧连接池上仍在进行的请求不受影响，最后一个请求结束后旧连接池随即关闭。
+    """
+
+    def __init__(self,
+                 max_connections: int = 10,
+                 max_keepalive_connections: int = 5,
+                 keepalive_expiry: float = 120.0,
+                 timeout: float = 60.0):
+        self.http2 = _http2_available()
+        self.limits = httpx.Limits(
+            max_connections=max_connections,  # 每个服务（主机）的最大连接数
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry
+        )
+        self.timeout = httpx.Timeout(timeout, connect=10.0)
+
+        self._clients: Dict[str, httpx.Client] = {}
+        self._trackers: Dict[str, _InflightTransport] = {}
+        self._retired: List[Tuple[httpx.Client, _InflightTransport]] = []
+        self._stats: Dict[str, Dict[str, int]] = {}
+        self._lock = threading.Lock()
+
+        if not self.http2:
+            logger.info("未安装h2，HTTP连接池使用HTTP/1.1 keep-alive")
+
+    def client(self, name: str) -> httpx.Client:
+        """获取指定服务的连接池，不存在时创建"""
+        with self._lock:
+            http_client = self._clients.get(name)
+            if http_client is None or http_client.is_closed:
+                http_client, tracker = self._build_client(name)
+                self._clients[name] = http_client
+                self._trackers[name] = tracker
+            return http_client
+
+    def reset(self, name: str, http_client: Optional[httpx.Client] = None) -> bool:
+        """丢弃指定服务的连接池，下次获取时重新建立
+
+        多个线程同时遇到连接错误时，只有第一个会重建：http_client为出错请求所用的连接池，
+        它已不是当前连接池时说明已被重建，直接返回False。旧连接池不立即关闭，
+        其他线程正在进行的请求可以正常完成，最后一个请求结束时关闭。
+        """
+        with self._lock:
+            current = self._clients.get(name)
+            if http_client is not None and http_client is not current:
+                return False
+            if current is not None:
+                del self._clients[name]
+                self._retired.append((current, self._trackers.pop(name)))
+            self._stats_for(name)['reconnects'] += 1
+        logger.info(f"已重置连接池: {name}")
+        self._close_idle_retired()
+        return True
+
+    def close(self):
+        """关闭所有连接池，包括已被重置的旧连接池"""
+        with self._lock:
+            clients = list(self._clients.values()) + [http_client for http_client, _ in self._retired]
+            self._clients.clear()
+            self._trackers.clear()
+            self._retired = []
+        for http_client in clients:
+            self._close_client(http_client)
+
+    def get_stats(self) -> Dict[str, Dict[str, int]]:
+        """获取各连接池的连接复用统计"""
+        with self._lock:
+            stats = {}
+            for name, pool_stats in self._stats.items():
+                pool_stats = dict(pool_stats)
+                pool_stats['reused_connections'] = max(
+                    pool_stats['requests'] - pool_stats['new_connections'], 0
+                )
+                stats[name] = pool_stats
+            return stats
+
+    def log_stats(self):
+        """输出连接复用统计"""
+        for name, pool_stats in self.get_stats().items():
+            requests = pool_stats['requests']
+            reuse_rate = pool_stats['reused_connections'] / requests * 100 if requests else 0.0
+            logger.info(
+                f"连接池 {name}: 请求 {requests}, 新建连接 {pool_stats['new_connections']}, "
+                f"TLS握手 {pool_stats['tls_handshakes']}, 复用率 {reuse_rate:.1f}%, "
+                f"重连 {pool_stats['reconnects']}"
+            )
+
+    def _stats_for(self, name: str) -> Dict[str, int]:
+        if name not in self._stats:
+            self._stats[name] = {
+                'requests': 0,
+                'new_connections': 0,
+                'tls_handshakes': 0,
+                'reconnects': 0,
+            }
+        return self._stats[name]
+
+    def _build_client(self, name: str) -> Tuple[httpx.Client, _InflightTransport]:
+        self._stats_for(name)
+        tracker = _InflightTransport(
+            httpx.HTTPTransport(http2=self.http2, limits=self.limits),
+            self._close_idle_retired
+        )
+        http_client = httpx.Client(
+            transport=tracker,
+            timeout=self.timeout,
+            event_hooks={'request': [partial(self._on_request, name)]}
+        )
+        return http_client, tracker
+
+    def _close_idle_retired(self):
+        """关闭已没有进行中请求的旧连接池"""
+        with self._lock:
+            if not self._retired:
+                return
+            idle = [http_client for http_client, tracker in self._retired if tracker.inflight == 0]
+            self._retired = [(http_client, tracker) for http_client, tracker in self._retired
+                             if tracker.inflight != 0]
+        for http_client in idle:
+            self._close_client(http_client)
+
+    @staticmethod
+    def _close_client(http_client: httpx.Client):
+        try:
+            http_client.close()
+        except Exception as e:
+            logger.warning(f"关闭连接池时出错: {e}")
+
+    def _on_request(self, name: str, request: httpx.Request):
+        # 通过httpcore的trace扩展统计新建连接与TLS握手
+        request.extensions['trace'] = partial(self._on_trace, name)
+        with self._lock:
+            self._stats_for(name)['requests'] += 1
+
+    def _on_trace(self, name: str, event_name: str, info: Dict):
+        if event_name == 'connection.connect_tcp.complete':
+            key = 'new_connections'
+        elif event_name == 'connection.start_tls.complete':
+            key = 'tls_handshakes'
+        else:
+            return
+        with self._lock:
+            self._stats_for(name)[key] += 1
+
+
+def create_supabase_client(settings: Dict[str, Optional[str]], transport: HttpTransport) -> Client:
+    """使用共享连接池创建Supabase客户端"""
+    options = ClientOptions(httpx_client=transport.client('supabase'))
+    return create_client(settings['supabase_url'], settings['supabase_key'], options=options)
+
+
+def create_openai_client(settings: Dict[str, Optional[str]], transport: HttpTransport) -> OpenAI:
+    """使用共享连接池创建OpenAI客户端，支持自定义base_url"""
+    kwargs = {
+        'api_key': settings['openai_api_key'],
+        'timeout': 60.0,  # 设置60秒超时
+        'http_client': transport.client('openai'),
+    }
+    if settings['openai_base_url']:
+        kwargs['base_url'] = settings['openai_base_url']
+    return OpenAI(**kwargs)
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+失败分类与死信队列
+功能：把处理失败归类为限流、超时、服务端、解析、内容五类，并持久化失败记录，供单独的重试流程按类别重放；
+      密钥、权限和模型不可用属于配置错误，直接停止运行，不写入死信队列
+作者：AI Assistant
+"""
+
+import json
+import sqlite3
+import threading
+from datetime import datetime
+from typing import Dict, List, Optional
+
+# 第三方库导入
+import httpx
+import openai
+
+# 失败类别
+RATE_LIMIT = 'rate_limit'  # 触发限流（429）
+TIMEOUT = 'timeout'        # 请求超时或连接中断
+SERVER = 'server'          # 服务端错误（5xx）或数据库写入失败
+PARSE = 'parse'            # 模型返回内容无法解析为完整的JSON
+CONTENT = 'content'        # 输入内容本身被拒绝（400：内容审核、超长等）
+AUTH = 'auth'              # 401/403：API密钥或权限错误，属于配置问题
+MODEL = 'model'            # 404：模型不存在或代理不提供该模型，属于路由问题
+
+# 以下两类不是记录本身的问题，不写入死信队列
+CONFIGURATION_REASONS = [AUTH, MODEL]
+
+FAILURE_REASONS = [RATE_LIMIT, TIMEOUT, SERVER, PARSE, CONTENT]
+
+# 各类失败在重试流程中使用的参数；None表示不自动重试，需要人工处理
+RETRY_POLICIES: Dict[str, Optional[Dict]] = {
+    RATE_LIMIT: {'max_retries': 5, 'base_delay': 15, 'request_timeout': 30, 'temperature': 0.3, 'record_delay': 5},
+    TIMEOUT: {'max_retries': 3, 'base_delay': 5, 'request_timeout': 90, 'temperature': 0.3, 'record_delay': 1},
+    SERVER: {'max_retries': 4, 'base_delay': 10, 'request_timeout': 60, 'temperature': 0.3, 'record_delay': 2},
+    PARSE: {'max_retries': 3, 'base_delay': 2, 'request_timeout': 30, 'temperature': 0.0, 'record_delay': 1},
+    CONTENT: None,
+}
+
+
+class ConfigurationError(Exception):
+    """配置错误（密钥无效、模型不可用等），继续处理只会让所有记录失败，需要停止运行"""
+
+
+class ProcessingError(Exception):
+    """记录处理失败，携带失败类别和所在阶段"""
+
+    def __init__(self, reason: str, message: str, stage: str):
+        super().__init__(message)
+        self.reason = reason
+        self.stage = stage
+
+
+def classify_error(error: Exception) -> str:
+    """根据异常类型判断失败类别"""
+    if isinstance(error, ProcessingError):
+        return error.reason
+    if isinstance(error, (json.JSONDecodeError, KeyError)):
+        return PARSE
+    if isinstance(error, (openai.APITimeoutError, openai.APIConnectionError, httpx.TimeoutException)):
+        return TIMEOUT
+    if isinstance(error, openai.APIStatusError):
+        status_code = error.status_code
+        if status_code == 400:
+            return CONTENT
+        if status_code in (401, 403):
+            return AUTH
+        if status_code == 404:
+            return MODEL
+        if status_code == 408:
+            return TIMEOUT
+        if status_code == 429:
+            return RATE_LIMIT
+        # 5xx以及其他4xx（409、422等）按可重试的服务端错误处理
+        return SERVER
+
+    # 其他异常（如Supabase返回的错误）按错误信息判断
+    error_msg = str(error).lower()
+    if '429' in error_msg or 'rate limit' in error_msg:
+        return RATE_LIMIT
+    if 'timeout' in error_msg or 'timed out' in error_msg:
+        return TIMEOUT
+    return SERVER
+
+
+class DeadLetterStore:
+    """基于SQLite的死信队列，按记录ID保存最近一次失败的原因"""
+
+    def __init__(self, path: str = 'dead_letters.db'):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS dead_letters (
+                record_id TEXT PRIMARY KEY,
+                filename TEXT,
+                stage TEXT NOT NULL,
+                reason TEXT NOT NULL,
+                error TEXT,
+                attempts INTEGER NOT NULL DEFAULT 1,
+                first_failed_at TEXT NOT NULL,
+                last_failed_at TEXT NOT NULL
+            )
+        ''')
+        self._conn.commit()
+
+    def add(self, record_id: str, filename: Optional[str], stage: str, reason: str, error: str):
+        """写入失败记录，已存在时累加失败次数"""
+        now = datetime.now().isoformat(timespec='seconds')
+        with self._lock:
+            self._conn.execute('''
+                INSERT INTO dead_letters
+                    (record_id, filename, stage, reason, error, attempts, first_failed_at, last_failed_at)
+                VALUES (?, ?, ?, ?, ?, 1, ?, ?)
+                ON CONFLICT(record_id) DO UPDATE SET
+                    stage = excluded.stage,
+                    reason = excluded.reason,
+                    error = excluded.error,
+                    attempts = dead_letters.attempts + 1,
+                    last_failed_at = excluded.last_failed_at
+            ''', (str(record_id), filename, stage, reason, error[:2000], now, now))
+            self._conn.commit()
+
+    def remove(self, record_id: str):
+        """记录处理成功后移出死信队列"""
+        with self._lock:
+            self._conn.execute('DELETE FROM dead_letters WHERE record_id = ?', (str(record_id),))
+            self._conn.commit()
+
+    def get_ids(self) -> List[str]:
+        """获取所有死信记录ID"""
+        with self._lock:
+            rows = self._conn.execute('SELECT record_id FROM dead_letters').fetchall()
+        return [row[0] for row in rows]
+
+    def entries(self, reason: Optional[str] = None, max_attempts: Optional[int] = None) -> List[Dict]:
+        """按类别获取死信记录，可排除失败次数过多的记录"""
+        sql = 'SELECT record_id, filename, stage, reason, error, attempts FROM dead_letters WHERE 1 = 1'
+        params: list = []
+        if reason:
+            sql += ' AND reason = ?'
+            params.append(reason)
+        if max_attempts:
+            sql += ' AND attempts < ?'
+            params.append(max_attempts)
+        sql += ' ORDER BY last_failed_at'
+
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+        keys = ['record_id', 'filename', 'stage', 'reason', 'error', 'attempts']
+        return [dict(zip(keys, row)) for row in rows]
+
+    def count_by_reason(self) -> Dict[str, int]:
+        """统计各失败类别的记录数"""
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT reason, COUNT(*) FROM dead_letters GROUP BY reason'
+            ).fetchall()
+        return dict(rows)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
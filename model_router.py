@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+模型路由
+功能：按描述文本的本地token数选择分析模型，
+      并根据各路由最近的解析失败率自动升级到更大的模型，同时统计每个路由的token用量和延迟
+作者：AI Assistant
+"""
+
+import logging
+import threading
+from collections import deque
+from typing import Dict, List, Optional
+
+from failure_handling import PARSE
+
+logger = logging.getLogger(__name__)
+
+# 7个字段的JSON输出长度与输入长度无关，所有路由使用相同的输出预算，低于800会截断JSON
+ANALYSIS_MAX_TOKENS = 800
+
+# 路由只决定模型，按输入长度从小到大排列；max_input_tokens为None表示不限
+MODEL_ROUTES: List[Dict] = [
+    {'name': 'short', 'model': 'gpt-4o-mini', 'max_input_tokens': 200},
+    {'name': 'standard', 'model': 'gpt-4o-2024-11-20', 'max_input_tokens': None},
+]
+
+
+def _load_encoder():
+    """加载tiktoken编码器，未安装时返回None"""
+    try:
+        import tiktoken
+        return tiktoken.get_encoding('o200k_base')  # gpt-4o系列使用的编码
+    except Exception:
+        return None
+
+
+class ModelRouter:
+    """分析模型路由器"""
+
+    def __init__(self,
+                 routes: Optional[List[Dict]] = None,
+                 window: int = 20,
+                 min_samples: int = 5,
+                 max_error_rate: float = 0.3):
+        """
+        Args:
+            routes: 路由列表，默认使用MODEL_ROUTES
+            window: 计算解析失败率时参考的最近调用次数
+            min_samples: 最近调用次数达到该值后才根据解析失败率升级
+            max_error_rate: 解析失败率超过该值时升级到下一个路由
+        """
+        self.routes = routes or MODEL_ROUTES
+        self.window = window
+        self.min_samples = min_samples
+        self.max_error_rate = max_error_rate
+        self._encoder = _load_encoder()
+        if self._encoder is None:
+            logger.info("未安装tiktoken，使用字符数估算token")
+
+        self._lock = threading.Lock()
+        self._recent = {route['name']: deque(maxlen=window) for route in self.routes}
+        self._skipped = {route['name']: 0 for route in self.routes}
+        self._unavailable = set()  # 返回404的模型，本次运行不再使用
+        self._stats = {
+            route['name']: {
+                'calls': 0,
+                'failures': 0,
+                'quality_failures': 0,
+                'input_tokens': 0,
+                'prompt_tokens': 0,
+                'completion_tokens': 0,
+                'latencies': deque(maxlen=500),
+            }
+            for route in self.routes
+        }
+
+    def count_tokens(self, text: str) -> int:
+        """本地计算文本token数"""
+        if self._encoder is not None:
+            return len(self._encoder.encode(text))
+        # 估算：中日韩字符约1个token，其他字符约4个字符1个token
+        cjk_chars = sum(1 for char in text if '⺀' <= char <= '鿿')
+        return cjk_chars + (len(text) - cjk_chars + 3) // 4
+
+    def choose(self, description: str) -> Dict:
+        """为描述文本选择路由，返回路由配置的副本（附带input_tokens）"""
+        input_tokens = self.count_tokens(description)
+
+        index = len(self.routes) - 1
+        for i, route in enumerate(self.routes):
+            if route['max_input_tokens'] is None or input_tokens <= route['max_input_tokens']:
+                index = i
+                break
+
+        # 模型不可用的路由直接升级；全部不可用时返回最后一个，由调用方的404处理停止运行
+        while index < len(self.routes) - 1 and self.routes[index]['model'] in self._unavailable:
+            index += 1
+
+        # 最近解析失败率过高的路由升级到下一个；被跳过window次后放行一次探测，避免永久停用
+        while index < len(self.routes) - 1 and self._error_rate(self.routes[index]['name']) > self.max_error_rate:
+            name = self.routes[index]['name']
+            with self._lock:
+                self._skipped[name] += 1
+                if self._skipped[name] >= self.window:
+                    self._skipped[name] = 0
+                    break
+            index += 1
+
+        route = dict(self.routes[index])
+        route['input_tokens'] = input_tokens
+        return route
+
+    def escalate(self, route: Dict) -> Dict:
+        """解析失败后升级到下一个路由，已是最后一个时保持不变"""
+        escalated = self._next_available(route)
+        if escalated is None:
+            return route
+        logger.info(f"路由升级: {route['name']} -> {escalated['name']}")
+        return escalated
+
+    def mark_unavailable(self, route: Dict) -> Optional[Dict]:
+        """模型返回404时停用该模型的所有路由，返回下一个可用路由；没有可用路由时返回None"""
+        with self._lock:
+            self._unavailable.add(route['model'])
+        logger.error(f"模型 {route['model']} 不可用，停用使用该模型的路由")
+        escalated = self._next_available(route)
+        if escalated is not None:
+            logger.info(f"路由升级: {route['name']} -> {escalated['name']}")
+        return escalated
+
+    def record(self, route: Dict, latency: float, usage=None):
+        """记录一次成功调用"""
+        with self._lock:
+            self._recent[route['name']].append(True)
+            stats = self._stats[route['name']]
+            stats['calls'] += 1
+            stats['input_tokens'] += route['input_tokens']
+            stats['latencies'].append(latency)
+            if usage is not None:
+                stats['prompt_tokens'] += usage.prompt_tokens
+                stats['completion_tokens'] += usage.completion_tokens
+
+    def record_failure(self, route: Dict, reason: str):
+        """记录一次失败调用
+
+        只有解析失败（输出不完整、缺少字段）反映路由的输出质量，计入升级用的错误率；
+        限流、超时、内容拒绝等与模型无关的失败只计数，也不记录延迟。
+        """
+        with self._lock:
+            stats = self._stats[route['name']]
+            stats['calls'] += 1
+            stats['failures'] += 1
+            stats['input_tokens'] += route['input_tokens']
+            if reason == PARSE:
+                stats['quality_failures'] += 1
+                self._recent[route['name']].append(False)
+
+    def get_stats(self) -> Dict[str, Dict]:
+        """获取各路由的调用统计"""
+        with self._lock:
+            result = {}
+            for name, stats in self._stats.items():
+                latencies = sorted(stats['latencies'])
+                result[name] = {
+                    'calls': stats['calls'],
+                    'failures': stats['failures'],
+                    'quality_failures': stats['quality_failures'],
+                    'input_tokens': stats['input_tokens'],
+                    'prompt_tokens': stats['prompt_tokens'],
+                    'completion_tokens': stats['completion_tokens'],
+                    'avg_latency': sum(latencies) / len(latencies) if latencies else 0.0,
+                    'p95_latency': latencies[int(len(latencies) * 0.95)] if latencies else 0.0,
+                }
+            return result
+
+    def log_stats(self):
+        """输出各路由的token用量和延迟"""
+        for name, stats in self.get_stats().items():
+            if not stats['calls']:
+                continue
+            logger.info(
+                f"路由 {name}: 调用 {stats['calls']}, 失败 {stats['failures']} "
+                f"(其中解析失败 {stats['quality_failures']}), "
+                f"本地输入token {stats['input_tokens']}, "
+                f"API token {stats['prompt_tokens']}+{stats['completion_tokens']}, "
+                f"成功调用平均延迟 {stats['avg_latency']:.2f}s, P95 {stats['p95_latency']:.2f}s"
+            )
+
+    def _next_available(self, route: Dict) -> Optional[Dict]:
+        names = [r['name'] for r in self.routes]
+        for candidate in self.routes[names.index(route['name']) + 1:]:
+            if candidate['model'] not in self._unavailable:
+                escalated = dict(candidate)
+                escalated['input_tokens'] = route['input_tokens']
+                return escalated
+        return None
+
+    def _error_rate(self, name: str) -> float:
+        with self._lock:
+            recent = self._recent[name]
+            if len(recent) < self.min_samples:
+                return 0.0
+            return 1 - sum(recent) / len(recent)
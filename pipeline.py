@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+有界流式处理管道
+功能：把数据源和若干处理阶段用有界队列串联起来，每个阶段运行在独立线程中。
+      下游处理不过来时队列写满，上游自动阻塞（背压），内存占用只与队列容量有关；
+      定期采样并汇报每个队列的占用情况
+作者：AI Assistant
+"""
+
+import time
+import queue
+import logging
+import threading
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, Type
+
+from tracing import Tracer
+
+logger = logging.getLogger(__name__)
+
+_END = object()  # 阶段结束标记
+
+
+class Stage:
+    """管道中的一个处理阶段
+
+    func接收上游的一个元素，返回交给下游的元素；返回None表示该元素已被丢弃（如处理失败）。
+    """
+
+    def __init__(self, name: str, func: Callable, workers: int = 1, queue_size: int = 10):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.queue_size = queue_size  # 该阶段输入队列的容量
+
+        self.processed = 0
+        self.dropped = 0
+        self._finished_workers = 0
+        self._lock = threading.Lock()
+
+
+class StreamingPipeline:
+    """有界队列串联的多线程处理管道"""
+
+    def __init__(self, source: Iterable, stages: List[Stage],
+                 tracer: Optional[Tracer] = None, report_interval: float = 30.0,
+                 sample_interval: float = 0.5, fatal_errors: Tuple[Type[Exception], ...] = ()):
+        """
+        Args:
+            source: 数据源，通常是生成器，在独立线程中迭代
+            stages: 按顺序排列的处理阶段
+            tracer: 开启追踪时把队列占用写为计数器事件
+            report_interval: 定期输出队列占用的间隔（秒）
+            sample_interval: 队列占用采样间隔（秒）
+            fatal_errors: 阶段抛出这些异常时停止整个管道，run()结束后重新抛出；
+                数据源出错时同样在run()结束后抛出
+        """
+        self.source = source
+        self.stages = stages
+        self.tracer = tracer or Tracer()
+        self.report_interval = report_interval
+        self.sample_interval = sample_interval
+        self.fatal_errors = fatal_errors
+        self.fatal_error: Optional[Exception] = None
+
+        self.queues = [queue.Queue(maxsize=stage.queue_size) for stage in stages]
+        self.source_count = 0
+        self._stop_event = threading.Event()
+        self._occupancy = {stage.name: {'samples': 0, 'total': 0, 'max': 0, 'full': 0} for stage in stages}
+
+    def run(self):
+        """启动所有阶段并等待处理完成；Ctrl+C时通知各线程退出"""
+        threads = [threading.Thread(target=self._run_source, name='source', daemon=True)]
+        for index, stage in enumerate(self.stages):
+            for worker in range(stage.workers):
+                threads.append(threading.Thread(
+                    target=self._run_stage, args=(index,), name=f"{stage.name}-{worker}", daemon=True
+                ))
+        monitor = threading.Thread(target=self._monitor, name='queue-monitor', daemon=True)
+
+        for thread in threads:
+            thread.start()
+        monitor.start()
+
+        try:
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(timeout=0.5)
+        except KeyboardInterrupt:
+            logger.info("收到中断信号，等待各阶段退出...")
+            self._stop_event.set()
+            for thread in threads:
+                thread.join(timeout=5)
+            raise
+        finally:
+            self._stop_event.set()
+            monitor.join()
+            self.log_stats()
+
+        if self.fatal_error is not None:
+            raise self.fatal_error
+
+    def stop(self):
+        self._stop_event.set()
+
+    def get_stats(self) -> Dict[str, Dict]:
+        """获取各阶段的处理数量和输入队列占用统计"""
+        stats = {}
+        for stage in self.stages:
+            occupancy = self._occupancy[stage.name]
+            samples = occupancy['samples'] or 1
+            stats[stage.name] = {
+                'processed': stage.processed,
+                'dropped': stage.dropped,
+                'queue_size': stage.queue_size,
+                'avg_queue': occupancy['total'] / samples,
+                'max_queue': occupancy['max'],
+                'full_ratio': occupancy['full'] / samples,
+            }
+        return stats
+
+    def log_stats(self):
+        """输出各阶段统计；队列长期写满的阶段即为瓶颈"""
+        logger.info(f"数据源产出 {self.source_count} 条")
+        for name, stats in self.get_stats().items():
+            logger.info(
+                f"阶段 {name}: 完成 {stats['processed']}, 丢弃 {stats['dropped']}, "
+                f"输入队列 平均 {stats['avg_queue']:.1f}/{stats['queue_size']}, "
+                f"峰值 {stats['max_queue']}, 写满 {stats['full_ratio'] * 100:.0f}%"
+            )
+
+    def _put(self, index: int, item) -> bool:
+        """写入下游队列，队列满时阻塞（背压）；管道停止时返回False"""
+        target = self.queues[index]
+        while not self._stop_event.is_set():
+            try:
+                target.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, index: int):
+        source = self.queues[index]
+        while not self._stop_event.is_set():
+            try:
+                return source.get(timeout=0.5)
+            except queue.Empty:
+                continue
+        return _END
+
+    def _finish(self, index: int):
+        """通知下一阶段的每个worker结束"""
+        if index < len(self.stages):
+            for _ in range(self.stages[index].workers):
+                if not self._put(index, _END):
+                    return
+
+    def _run_source(self):
+        try:
+            for item in self.source:
+                if not self._put(0, item):
+                    return
+                self.source_count += 1
+        except Exception as e:
+            # 已取出的元素继续处理完，run()结束后抛出，避免把数据源故障当作正常结束
+            logger.error(f"数据源出错: {e}")
+            self.fatal_error = e
+        finally:
+            self._finish(0)
+
+    def _run_stage(self, index: int):
+        stage = self.stages[index]
+        while True:
+            item = self._get(index)
+            if item is _END:
+                break
+            try:
+                result = stage.func(item)
+            except self.fatal_errors as e:
+                logger.error(f"阶段 {stage.name} 遇到致命错误，停止管道: {e}")
+                self.fatal_error = e
+                self._stop_event.set()
+                break
+            except Exception as e:
+                logger.error(f"阶段 {stage.name} 处理出错: {e}")
+                result = None
+
+            with stage._lock:
+                if result is None:
+                    stage.dropped += 1
+                else:
+                    stage.processed += 1
+            if result is not None and index + 1 < len(self.stages):
+                if not self._put(index + 1, result):
+                    break
+
+        # 本阶段最后一个退出的worker负责通知下游
+        with stage._lock:
+            stage._finished_workers += 1
+            last_worker = stage._finished_workers == stage.workers
+        if last_worker:
+            self._finish(index + 1)
+
+    def _monitor(self):
+        last_report = time.monotonic()
+        while not self._stop_event.wait(self.sample_interval):
+            sizes = {}
+            for stage, stage_queue in zip(self.stages, self.queues):
+                size = stage_queue.qsize()
+                occupancy = self._occupancy[stage.name]
+                occupancy['samples'] += 1
+                occupancy['total'] += size
+                occupancy['max'] = max(occupancy['max'], size)
+                if size >= stage.queue_size:
+                    occupancy['full'] += 1
+                sizes[stage.name] = size
+            self.tracer.counter('queue_occupancy', sizes)
+
+            if time.monotonic() - last_report >= self.report_interval:
+                last_report = time.monotonic()
+                summary = ', '.join(
+                    f"{stage.name} {sizes[stage.name]}/{stage.queue_size}" for stage in self.stages
+                )
+                logger.info(f"队列占用: {summary}")
@@ -6,18 +6,32 @@
 作者：AI Assistant
 """
 
-import os
 import json
 import time
+import argparse
+import threading
+from array import array
 import logging
-from typing import List, Dict, Optional, Tuple
+from contextlib import contextmanager
+from typing import Iterator, List, Dict, Optional, Tuple
 from datetime import datetime
 import random
 
 # 第三方库导入
+import httpx
 import openai
-from supabase import create_client, Client
-from openai import OpenAI
+from supabase import Client
+
+from clients import (
+    HttpTransport, load_client_settings, create_supabase_client, create_openai_client, EMBEDDING_MODEL
+)
+from failure_handling import (
+    DeadLetterStore, ProcessingError, ConfigurationError, classify_error,
+    FAILURE_REASONS, RETRY_POLICIES, CONTENT, PARSE, SERVER, AUTH, MODEL
+)
+from tracing import Tracer, ProfileSession
+from model_router import ModelRouter, ANALYSIS_MAX_TOKENS
+from pipeline import StreamingPipeline, Stage
 
 # 配置日志
 logging.basicConfig(
@@ -30,15 +44,56 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+def _is_connection_error(error: Exception) -> bool:
+    """是否为连接被断开等真正的连接错误
+
+    APITimeoutError是APIConnectionError的子类，但单次请求慢不代表连接池坏了，不应重建连接池。
+    """
+    return isinstance(error, openai.APIConnectionError) and not isinstance(error, openai.APITimeoutError)
+
+def _is_network_error(error: Exception) -> bool:
+    """Supabase请求是否因网络问题失败（连接断开、超时），这类错误重连后可以重试"""
+    if isinstance(error, httpx.TransportError):
+        return True
+    error_msg = str(error).lower()
+    return any(keyword in error_msg for keyword in [
+        'winerror 10054', 'connection', 'timeout', 'network', 
+        '远程主机强迫关闭', 'connection reset', 'connection aborted'
+    ])
+
+def _vector_literal(values: array) -> str:
+    """把float32向量格式化为pgvector文本格式，9位有效数字足以无损表示float32"""
+    return '[' + ','.join(f"{value:.9g}" for value in values) + ']'
+
 class StableIllustrationProcessor:
     """绘本插图数据处理器 - 稳定版本"""
     
-    def __init__(self):
-        """初始化处理器，设置API客户端"""
+    def __init__(self, allow_fallback: bool = False, tracer: Optional[Tracer] = None,
+                 analyze_workers: int = 2, queue_size: int = 10):
+        """初始化处理器，设置API客户端
+
+        Args:
+            allow_fallback: AI分析最终失败时是否写入备用分析文本（默认写入死信队列）
+            tracer: 阶段耗时追踪器，为None时不记录
+            analyze_workers: 并行调用GPT分析的线程数
+            queue_size: 各阶段之间队列的容量
+        """
+        self.tracer = tracer or Tracer()
+        self.settings = load_client_settings()
+        self.transport = HttpTransport()
         self.setup_clients()
         self.batch_size = 5  # 减少批次大小提升稳定性
         self.max_retries = 3  # 最大重试次数
         self.base_delay = 2   # 基础延迟时间（秒）
+        self.request_timeout = 30  # 单次API请求超时（秒）
+        self.temperature = 0.3
+        self.record_delay = 1  # 记录间延迟（秒）
+        self.allow_fallback = allow_fallback
+        self.dead_letters = DeadLetterStore()
+        self.router = ModelRouter()
+        self.analyze_workers = analyze_workers
+        self.queue_size = queue_size
+        self._reconnect_lock = threading.Lock()
         
         # 定义7个主题字段
         self.theme_fields = [
@@ -55,100 +110,127 @@ class StableIllustrationProcessor:
         self.embedding_fields = [f"{field}_embedding" for field in self.theme_fields]
         
     def setup_clients(self):
-        """设置Supabase和OpenAI客户端"""
-        # 优先从环境变量获取配置，如果没有则从config.py获取
-        supabase_url = os.getenv('SUPABASE_URL')
-        supabase_key = os.getenv('SUPABASE_SERVICE_ROLE_KEY')  # 使用SERVICE_ROLE_KEY
-        openai_api_key = os.getenv('OPENAI_API_KEY')
-        
-        # 尝试从config.py导入配置（优先使用config.py中的配置）
-        openai_base_url = None
-        try:
-            import config
-            supabase_url = config.SUPABASE_URL
-            supabase_key = getattr(config, 'SUPABASE_SERVICE_ROLE_KEY', config.SUPABASE_ANON_KEY)
-            openai_api_key = config.OPENAI_API_KEY
-            # 检查是否有自定义的OpenAI Base URL
-            if hasattr(config, 'OPENAI_BASE_URL'):
-                openai_base_url = config.OPENAI_BASE_URL
-            logger.info("从config.py文件加载配置")
-        except ImportError:
-            logger.info("config.py不存在，使用环境变量")
-            pass
-        
-        if not all([supabase_url, supabase_key, openai_api_key]):
-            raise ValueError("请设置环境变量或在config.py中配置：SUPABASE_URL, SUPABASE_SERVICE_ROLE_KEY, OPENAI_API_KEY")
-        
-        # 初始化客户端
-        self.supabase: Client = create_client(supabase_url, supabase_key)
-        
-        # 初始化OpenAI客户端，支持自定义base_url
-        if openai_base_url:
-            self.openai_client = OpenAI(
-                api_key=openai_api_key, 
-                base_url=openai_base_url,
-                timeout=60.0  # 设置60秒超时
-            )
-            logger.info(f"使用自定义OpenAI API地址: {openai_base_url}")
-        else:
-            self.openai_client = OpenAI(
-                api_key=openai_api_key,
-                timeout=60.0  # 设置60秒超时
-            )
+        """设置Supabase和OpenAI客户端（共享连接池）"""
+        self.supabase: Client = create_supabase_client(self.settings, self.transport)
+        self.openai_client = create_openai_client(self.settings, self.transport)
+        # 各客户端创建时使用的连接池，重连时用来判断是否已被其他线程重建
+        self._pools = {name: self.transport.client(name) for name in ['supabase', 'openai']}
+        
+        if self.settings['openai_base_url']:
+            logger.info(f"使用自定义OpenAI API地址: {self.settings['openai_base_url']}")
         
         logger.info("客户端初始化成功")
     
+    def reconnect(self, name: str, failed_client):
+        """只重建出错服务的连接池和客户端，不重新加载配置
+
+        failed_client为出错请求使用的客户端。多个worker同时遇到连接错误时只重建一次：
+        客户端已被其他worker换掉时直接使用新客户端重试。旧连接池不关闭，其上的请求继续完成。
+        """
+        with self._reconnect_lock:
+            current = self.supabase if name == 'supabase' else self.openai_client
+            if failed_client is not current:
+                return
+            self.transport.reset(name, self._pools[name])
+            if name == 'supabase':
+                self.supabase = create_supabase_client(self.settings, self.transport)
+            elif name == 'openai':
+                self.openai_client = create_openai_client(self.settings, self.transport)
+            self._pools[name] = self.transport.client(name)
+    
+    def sleep(self, seconds: float):
+        """等待指定秒数，开启追踪时记录为sleep区间"""
+        with self.tracer.span('sleep', seconds=round(seconds, 2)):
+            time.sleep(seconds)
+    
     def exponential_backoff(self, attempt: int) -> float:
         """指数退避算法"""
         delay = self.base_delay * (2 ** attempt) + random.uniform(0, 1)
         return min(delay, 60)  # 最大延迟60秒
     
-    def get_pending_records(self, force_update: bool = False, processed_ids: set = None) -> Tuple[List[Dict], bool]:
-        """获取待处理的记录
+    def get_pending_records(self, force_update: bool = False,
+                            after_id: Optional[str] = None) -> Tuple[List[Dict], bool]:
+        """按ID顺序分页获取待处理的记录
+        
+        使用 id > after_id 的游标分页，不需要在内存中保存已处理的ID。
+        
         Returns:
             tuple: (records_list, is_network_error)
+        
+        Raises:
+            Exception: 非网络错误（如请求被拒绝、查询语法错误）直接抛出，不能当作没有更多记录
         """
         try:
+            query = self.supabase.table('illustrations_optimized') \
+                .select('id, filename, original_description')
+            
             if force_update:
-                # 强制更新模式：获取所有有original_description的记录，但排除本次已处理的
-                query = self.supabase.table('illustrations_optimized') \
-                    .select('id, filename, original_description') \
-                    .not_.is_('original_description', 'null')
-                
-                # 如果有已处理的ID列表，排除它们
-                if processed_ids:
-                    query = query.not_.in_('id', list(processed_ids))
-                
-                response = query.limit(self.batch_size).execute()
-                
-                if not processed_ids:  # 只在第一次显示
-                    logger.info("强制更新模式：将重新处理所有记录")
+                # 强制更新模式：获取所有有original_description的记录
+                query = query.not_.is_('original_description', 'null')
             else:
                 # 正常模式：只处理theme_philosophy为NULL的记录
-                response = self.supabase.table('illustrations_optimized') \
-                    .select('id, filename, original_description') \
-                    .is_('theme_philosophy', 'null') \
-                    .limit(self.batch_size) \
-                    .execute()
+                query = query.is_('theme_philosophy', 'null')
+            
+            if after_id is not None:
+                query = query.gt('id', after_id)
             
+            response = query.order('id').limit(self.batch_size).execute()
             return response.data, False
         except Exception as e:
-            error_msg = str(e)
             logger.error(f"获取待处理记录失败: {e}")
             
             # 检查是否是网络连接错误
-            is_network_error = any(keyword in error_msg.lower() for keyword in [
-                'winerror 10054', 'connection', 'timeout', 'network', 
-                '远程主机强迫关闭', 'connection reset', 'connection aborted'
-            ])
+            if not _is_network_error(e):
+                raise
             
-            return [], is_network_error
+            return [], True
     
-    def analyze_with_gpt4_stable(self, description: str) -> Optional[Dict]:
-        """使用GPT-4o分析描述文本，提取7个主题字段 - 稳定版本"""
+    def iter_pending_records(self, force_update: bool = False) -> Iterator[Dict]:
+        """逐条产出待处理记录，网络错误时只重建Supabase连接池后重试
+        
+        死信队列中的记录由单独的重试流程处理，在本地跳过，不放进查询条件里。
+        """
+        if force_update:
+            logger.info("强制更新模式：将重新处理所有记录")
+        
+        excluded_ids = set(self.dead_letters.get_ids())
+        after_id = None
+        max_reconnect_attempts = 3 # 最大重连尝试次数
+        current_reconnect_attempt = 0
         
+        while True:
+            supabase = self.supabase
+            with self.tracer.span('fetch'):
+                records, is_network_error = self.get_pending_records(force_update, after_id)
+            
+            if not records:
+                if not is_network_error:
+                    # 真正没有更多数据
+                    logger.info("没有更多待处理记录")
+                    return
+                
+                current_reconnect_attempt += 1
+                if current_reconnect_attempt > max_reconnect_attempts:
+                    logger.error(f"达到最大重连尝试次数 ({max_reconnect_attempts})，停止获取记录。")
+                    return
+                
+                delay = self.exponential_backoff(current_reconnect_attempt - 1)
+                logger.warning(f"检测到网络错误，{delay:.1f}秒后重连 "
+                               f"({current_reconnect_attempt}/{max_reconnect_attempts})...")
+                self.sleep(delay)
+                self.reconnect('supabase', supabase)
+                continue
+            
+            current_reconnect_attempt = 0  # 获取成功后重置计数器
+            after_id = records[-1]['id']
+            records = [record for record in records if str(record['id']) not in excluded_ids]
+            logger.info(f"获取到 {len(records)} 条待处理记录")
+            yield from records
+    
+    def build_analysis_prompt(self, description: str) -> str:
+        """构建主题字段分析的prompt"""
         # 完整的prompt，包含详细的字段填写指南
-        prompt = f"""目标：请你扮演一位资深的文本分析和信息提取专家。你的任务是深入分析我提供的这段关于绘本插图的详细描述文字，并从中提取关键信息，为一个JSON对象中的7个核心字段填充内容。
+        return f"""目标：请你扮演一位资深的文本分析和信息提取专家。你的任务是深入分析我提供的这段关于绘本插图的详细描述文字，并从中提取关键信息，为一个JSON对象中的7个核心字段填充内容。
 
 输入：一段关于绘本插图的详细描述文字。
 
@@ -175,56 +257,101 @@ class StableIllustrationProcessor:
 
 待分析的描述文字：
 {description}"""
+    
+    def analyze_with_gpt4_stable(self, description: str, record_id: Optional[str] = None) -> Dict:
+        """使用GPT-4o分析描述文本，提取7个主题字段 - 稳定版本
 
-        for attempt in range(self.max_retries):
+        模型由路由器按描述长度选择，解析失败时升级到更大的模型。
+
+        Raises:
+            ProcessingError: 重试耗尽且未启用备用分析时抛出，携带失败类别
+            ConfigurationError: 密钥/权限错误，或所有可选模型都不可用
+        """
+        with self.tracer.span('prompt_build'):
+            prompt = self.build_analysis_prompt(description)
+        route = self.router.choose(description)
+
+        last_error: Optional[Exception] = None
+        attempt = 0
+        while attempt < self.max_retries:
+            started = time.perf_counter()
+            openai_client = self.openai_client
             try:
-                logger.info(f"尝试GPT-4分析 (第{attempt + 1}次)")
+                logger.info(f"尝试GPT-4分析 (第{attempt + 1}次, 路由 {route['name']}: {route['model']})")
                 
-                response = self.openai_client.chat.completions.create(
-                    model="gpt-4o-2024-11-20",
-                    messages=[
-                        {
-                            "role": "system",
-                            "content": "你是专业的文本分析专家。请严格按照JSON格式返回结果，不要添加任何解释。"
-                        },
-                        {
-                            "role": "user", 
-                            "content": prompt
-                        }
-                    ],
-                    temperature=0.3,
-                    max_tokens=800,  # 减少token数量
-                    timeout=30  # 30秒超时
-                )
+                with self.tracer.span('chat', record_id=record_id, attempt=attempt + 1, route=route['name']):
+                    response = openai_client.chat.completions.create(
+                        model=route['model'],
+                        messages=[
+                            {
+                                "role": "system",
+                                "content": "你是专业的文本分析专家。请严格按照JSON格式返回结果，不要添加任何解释。"
+                            },
+                            {
+                                "role": "user", 
+                                "content": prompt
+                            }
+                        ],
+                        temperature=self.temperature,
+                        max_tokens=ANALYSIS_MAX_TOKENS,
+                        timeout=self.request_timeout
+                    )
                 
-                # 解析JSON响应
-                content = response.choices[0].message.content.strip()
+                latency = time.perf_counter() - started
                 
-                # 移除可能的markdown代码块标记
-                if content.startswith('```json'):
-                    content = content[7:]
-                if content.endswith('```'):
-                    content = content[:-3]
-                
-                result = json.loads(content)
+                with self.tracer.span('parse'):
+                    result = self.parse_analysis(response.choices[0].message.content)
+                self.router.record(route, latency, response.usage)
                 logger.info("GPT-4分析成功")
                 return result
                 
-            except json.JSONDecodeError as e:
-                logger.error(f"JSON解析失败 (第{attempt + 1}次): {e}")
-                if attempt == self.max_retries - 1:
-                    return self.get_fallback_analysis(description)
-                    
             except Exception as e:
-                logger.error(f"GPT-4分析失败 (第{attempt + 1}次): {e}")
-                if attempt < self.max_retries - 1:
-                    delay = self.exponential_backoff(attempt)
+                reason = classify_error(e)
+                logger.error(f"GPT-4分析失败 (第{attempt + 1}次, {reason}): {e}")
+                self.router.record_failure(route, reason)
+                if _is_connection_error(e):
+                    self.reconnect('openai', openai_client)
+                last_error = e
+                if reason == AUTH:
+                    raise ConfigurationError(f"OpenAI认证失败，请检查API密钥和权限: {e}") from e
+                if reason == MODEL:
+                    # 模型不存在是路由问题，换用下一个可用模型
+                    route = self.router.mark_unavailable(route)
+                    if route is None:
+                        raise ConfigurationError(f"没有可用的分析模型: {e}") from e
+                    # 换模型不计入重试次数
+                    continue
+                attempt += 1
+                if reason == CONTENT:
+                    # 内容被拒绝，重试无意义
+                    break
+                if reason == PARSE:
+                    # 解析失败说明当前路由输出不可靠，升级后直接重试
+                    route = self.router.escalate(route)
+                elif attempt < self.max_retries:
+                    delay = self.exponential_backoff(attempt - 1)
                     logger.info(f"等待 {delay:.1f} 秒后重试...")
-                    time.sleep(delay)
-                else:
-                    return self.get_fallback_analysis(description)
+                    self.sleep(delay)
         
-        return None
+        if self.allow_fallback:
+            return self.get_fallback_analysis(description)
+        raise ProcessingError(classify_error(last_error), str(last_error), 'analyze')
+    
+    def parse_analysis(self, content: str) -> Dict:
+        """解析GPT返回的JSON，并检查7个主题字段是否齐全"""
+        content = content.strip()
+        
+        # 移除可能的markdown代码块标记
+        if content.startswith('```json'):
+            content = content[7:]
+        if content.endswith('```'):
+            content = content[:-3]
+        
+        result = json.loads(content)
+        missing_fields = [field for field in self.theme_fields if not result.get(field)]
+        if missing_fields:
+            raise ProcessingError(PARSE, f"缺少字段: {', '.join(missing_fields)}", 'analyze')
+        return result
     
     def get_fallback_analysis(self, description: str) -> Dict:
         """当AI分析失败时的备用分析"""
@@ -239,166 +366,331 @@ class StableIllustrationProcessor:
             "scene_visuals": f"温馨的画面场景，描述长度：{len(description)}字符"
         }
     
-    def generate_embeddings_stable(self, texts: List[str]) -> Optional[List[List[float]]]:
-        """为文本列表生成向量嵌入 - 稳定版本"""
+    def generate_embeddings_stable(self, texts: List[str], record_id: Optional[str] = None) -> List[List[float]]:
+        """为文本列表生成向量嵌入 - 稳定版本
+
+        Raises:
+            ProcessingError: 没有有效文本或重试耗尽时抛出，携带失败类别
+            ConfigurationError: 密钥/权限错误或向量模型不可用
+        """
         
+        # 过滤空文本
+        valid_texts = [text for text in texts if text and text.strip()]
+        if not valid_texts:
+            raise ProcessingError(CONTENT, "没有可生成向量的文本", 'embed')
+        
+        last_error: Optional[Exception] = None
         for attempt in range(self.max_retries):
+            openai_client = self.openai_client
             try:
-                # 过滤空文本
-                valid_texts = [text for text in texts if text and text.strip()]
-                if not valid_texts:
-                    return None
-                
                 logger.info(f"生成向量嵌入 (第{attempt + 1}次) - {len(valid_texts)}个文本")
                 
-                response = self.openai_client.embeddings.create(
-                    model="text-embedding-3-small",
-                    input=valid_texts,
-                    encoding_format="float",
-                    timeout=30  # 30秒超时
-                )
+                with self.tracer.span('embed', record_id=record_id, attempt=attempt + 1, texts=len(valid_texts)):
+                    response = openai_client.embeddings.create(
+                        model=EMBEDDING_MODEL,
+                        input=valid_texts,
+                        encoding_format="float",
+                        timeout=self.request_timeout
+                    )
                 
                 embeddings = [embedding.embedding for embedding in response.data]
                 logger.info(f"向量嵌入生成成功 - {len(embeddings)}个向量")
                 return embeddings
                 
             except Exception as e:
-                logger.error(f"向量嵌入生成失败 (第{attempt + 1}次): {e}")
+                reason = classify_error(e)
+                logger.error(f"向量嵌入生成失败 (第{attempt + 1}次, {reason}): {e}")
+                if _is_connection_error(e):
+                    self.reconnect('openai', openai_client)
+                last_error = e
+                if reason in (AUTH, MODEL):
+                    raise ConfigurationError(f"向量模型 {EMBEDDING_MODEL} 调用失败 ({reason}): {e}") from e
+                if reason == CONTENT:
+                    break
                 if attempt < self.max_retries - 1:
                     delay = self.exponential_backoff(attempt)
                     logger.info(f"等待 {delay:.1f} 秒后重试...")
-                    time.sleep(delay)
+                    self.sleep(delay)
         
         logger.error("向量嵌入生成最终失败，跳过此记录")
-        return None
+        raise ProcessingError(classify_error(last_error), str(last_error), 'embed')
+    
+    def analyze_record(self, record: Dict) -> Dict:
+        """分析记录的描述文本，返回7个主题字段"""
+        logger.info(f"正在处理记录ID: {record['id']}, 文件名: {record.get('filename')}")
+        return self.analyze_with_gpt4_stable(record['original_description'], record['id'])
+    
+    def embed_record(self, record: Dict, analysis_result: Dict) -> Dict:
+        """为主题字段生成向量，返回待写入的更新数据
+        
+        向量以float32数组保存（pgvector本身按float32存储，不损失精度），
+        在写入前的队列中每条记录只占约43KB，而不是数十万字节的Python浮点数列表。
+        """
+        theme_texts = [analysis_result[field] for field in self.theme_fields]
+        embeddings = self.generate_embeddings_stable(theme_texts, record['id'])
+        
+        if len(embeddings) != len(self.theme_fields):
+            raise ProcessingError(CONTENT, f"向量数量不匹配: {len(embeddings)}", 'embed')
+        
+        update_data = {field: analysis_result[field] for field in self.theme_fields}
+        for embedding_field, embedding in zip(self.embedding_fields, embeddings):
+            update_data[embedding_field] = array('f', embedding)
+        return update_data
+    
+    def write_record(self, record: Dict, update_data: Dict):
+        """把更新数据写入数据库
+
+        网络错误时重建Supabase连接池后重试（更新是幂等的），避免已付费的分析和向量结果
+        因为一次断线进入死信队列；重试耗尽或其他错误时抛出。
+        """
+        record_id = record['id']
+        
+        # 只计时向量格式化；请求体的JSON编码发生在execute()内，计入update
+        with self.tracer.span('format_vectors', record_id=record_id):
+            payload = {
+                key: _vector_literal(value) if isinstance(value, array) else value
+                for key, value in update_data.items()
+            }
+        
+        for attempt in range(self.max_retries):
+            supabase = self.supabase
+            try:
+                with self.tracer.span('update', record_id=record_id, attempt=attempt + 1):
+                    response = supabase.table('illustrations_optimized') \
+                        .update(payload) \
+                        .eq('id', record_id) \
+                        .execute()
+                break
+            except Exception as e:
+                if not _is_network_error(e) or attempt == self.max_retries - 1:
+                    raise
+                delay = self.exponential_backoff(attempt)
+                logger.warning(f"写入记录 {record_id} 时网络错误 (第{attempt + 1}次)，{delay:.1f}秒后重连重试: {e}")
+                self.sleep(delay)
+                # 超时不代表连接池坏了，直接重试
+                if not isinstance(e, httpx.TimeoutException):
+                    self.reconnect('supabase', supabase)
+        
+        if not response.data:
+            raise ProcessingError(SERVER, "数据库更新未返回数据", 'update')
+        
+        logger.info(f"✅ 记录 {record_id} 处理成功")
+        self.dead_letters.remove(record_id)
+    
+    def record_failure(self, record: Dict, error: Exception, stage: str):
+        """记录处理失败，写入死信队列"""
+        record_id = record.get('id', 'unknown')
+        if isinstance(error, ProcessingError):
+            stage, reason = error.stage, error.reason
+        else:
+            reason = classify_error(error)
+        logger.error(f"❌ 记录 {record_id} 处理失败 ({stage}/{reason}): {error}")
+        self.dead_letters.add(record_id, record.get('filename'), stage, reason, str(error))
     
     def process_single_record(self, record: Dict) -> bool:
-        """处理单条记录"""
+        """顺序处理单条记录，失败时写入死信队列"""
+        stage = 'analyze'
         try:
-            record_id = record['id']
-            filename = record['filename']
-            original_description = record['original_description']
-            
-            logger.info(f"正在处理记录ID: {record_id}, 文件名: {filename}")
-            
-            # 1. 使用GPT-4分析描述文本
-            analysis_result = self.analyze_with_gpt4_stable(original_description)
-            if not analysis_result:
-                logger.error(f"跳过记录 {record_id}: GPT-4分析失败")
-                return False
-            
-            # 2. 生成向量嵌入
-            theme_texts = [analysis_result[field] for field in self.theme_fields]
-            embeddings = self.generate_embeddings_stable(theme_texts)
-            
-            if not embeddings or len(embeddings) != len(self.theme_fields):
-                logger.error(f"跳过记录 {record_id}: 向量嵌入生成失败")
-                return False
-            
-            # 3. 准备更新数据
-            update_data = {}
-            
-            # 添加主题字段
-            for field in self.theme_fields:
-                update_data[field] = analysis_result[field]
+            analysis_result = self.analyze_record(record)
+            stage = 'embed'
+            update_data = self.embed_record(record, analysis_result)
+            stage = 'update'
+            self.write_record(record, update_data)
+            return True
+        except ConfigurationError:
+            raise
+        except Exception as e:
+            self.record_failure(record, e, stage)
+            return False
+    
+    @contextmanager
+    def retry_policy(self, policy: Dict):
+        """临时应用某一失败类别对应的重试参数"""
+        keys = ['max_retries', 'base_delay', 'request_timeout', 'temperature', 'record_delay']
+        saved = {key: getattr(self, key) for key in keys}
+        try:
+            for key in keys:
+                setattr(self, key, policy[key])
+            yield
+        finally:
+            for key, value in saved.items():
+                setattr(self, key, value)
+    
+    def retry_dead_letters(self, max_attempts: int = 5):
+        """按失败类别重放死信队列中的记录"""
+        logger.info("开始重试死信队列")
+        
+        recovered_count = 0
+        failed_count = 0
+        missing_count = 0
+        
+        for reason in FAILURE_REASONS:
+            entries = self.dead_letters.entries(reason, max_attempts=max_attempts)
+            if not entries:
+                continue
             
-            # 添加向量字段
-            for i, embedding_field in enumerate(self.embedding_fields):
-                update_data[embedding_field] = embeddings[i]
+            policy = RETRY_POLICIES[reason]
+            if policy is None:
+                logger.warning(f"{reason} 类失败 {len(entries)} 条需要人工处理，跳过自动重试")
+                continue
             
-            # 4. 更新数据库
-            response = self.supabase.table('illustrations_optimized') \
-                .update(update_data) \
-                .eq('id', record_id) \
-                .execute()
+            logger.info(f"重试 {reason} 类失败记录 {len(entries)} 条")
             
-            if response.data:
-                logger.info(f"✅ 记录 {record_id} 处理成功")
-                return True
-            else:
-                logger.error(f"❌ 记录 {record_id} 数据库更新失败")
-                return False
-                
-        except Exception as e:
-            logger.error(f"处理记录 {record.get('id', 'unknown')} 时出错: {e}")
-            return False
+            with self.retry_policy(policy):
+                for start in range(0, len(entries), self.batch_size):
+                    ids = [entry['record_id'] for entry in entries[start:start + self.batch_size]]
+                    try:
+                        response = self.supabase.table('illustrations_optimized') \
+                            .select('id, filename, original_description') \
+                            .in_('id', ids) \
+                            .execute()
+                    except Exception as e:
+                        logger.error(f"获取死信记录失败: {e}")
+                        failed_count += len(ids)
+                        continue
+                    
+                    # 已从数据库删除的记录不会出现在结果中，从死信队列移除
+                    missing_ids = set(ids) - {str(record['id']) for record in response.data}
+                    for record_id in sorted(missing_ids):
+                        logger.warning(f"死信记录 {record_id} 已不在数据库中，移出死信队列")
+                        self.dead_letters.remove(record_id)
+                    missing_count += len(missing_ids)
+                    
+                    for record in response.data:
+                        try:
+                            recovered = self.process_single_record(record)
+                        except ConfigurationError as e:
+                            logger.error(f"配置错误，停止重试: {e}")
+                            return
+                        if recovered:
+                            recovered_count += 1
+                        else:
+                            failed_count += 1
+                        self.sleep(self.record_delay)
+        
+        logger.info(f"死信重试完成！恢复: {recovered_count}, 仍失败: {failed_count}, "
+                    f"记录已删除: {missing_count}")
+        self.log_dead_letter_summary()
+        self.router.log_stats()
+    
+    def log_dead_letter_summary(self):
+        """输出死信队列中各失败类别的记录数"""
+        counts = self.dead_letters.count_by_reason()
+        if counts:
+            summary = ', '.join(f"{reason}: {count}" for reason, count in sorted(counts.items()))
+            logger.info(f"死信队列: {summary}")
     
     def run_stable(self, force_update: bool = False):
-        """运行稳定版本的处理流程"""
+        """运行稳定版本的处理流程
+        
+        获取 → 分析 → 向量 → 写入 四个阶段通过有界队列连接：
+        内存占用只与队列容量有关，慢阶段的队列写满后快阶段自动等待。
+        """
         logger.info("开始稳定版本的插图数据处理")
         
-        processed_count = 0
-        failed_count = 0
-        processed_ids = set()
+        def analyze_stage(record: Dict) -> Optional[Tuple[Dict, Dict]]:
+            meta = {'id': record['id'], 'filename': record.get('filename')}
+            try:
+                with self.tracer.span('record', record_id=record['id']):
+                    return meta, self.analyze_record(record)
+            except ConfigurationError:
+                raise
+            except Exception as e:
+                self.record_failure(meta, e, 'analyze')
+                return None
+            finally:
+                # 每个分析worker记录间的短暂延迟，控制API请求速率
+                self.sleep(self.record_delay)
         
-        max_reconnect_attempts = 3 # 最大重连尝试次数
-        current_reconnect_attempt = 0
+        def embed_stage(item: Tuple[Dict, Dict]) -> Optional[Tuple[Dict, Dict]]:
+            meta, analysis_result = item
+            try:
+                return meta, self.embed_record(meta, analysis_result)
+            except ConfigurationError:
+                raise
+            except Exception as e:
+                self.record_failure(meta, e, 'embed')
+                return None
+        
+        def write_stage(item: Tuple[Dict, Dict]) -> Optional[str]:
+            meta, update_data = item
+            try:
+                self.write_record(meta, update_data)
+                return meta['id']
+            except ConfigurationError:
+                raise
+            except Exception as e:
+                self.record_failure(meta, e, 'update')
+                return None
+        
+        pipeline = StreamingPipeline(
+            self.iter_pending_records(force_update),
+            [
+                Stage('analyze', analyze_stage, workers=self.analyze_workers, queue_size=self.queue_size),
+                Stage('embed', embed_stage, queue_size=self.queue_size),
+                Stage('write', write_stage, queue_size=self.queue_size),
+            ],
+            tracer=self.tracer,
+            fatal_errors=(ConfigurationError,)
+        )
         
         try:
-            while True:
-                # 获取待处理记录
-                records, is_network_error = self.get_pending_records(force_update, processed_ids)
-                
-                if not records:
-                    if is_network_error:
-                        # 网络错误，尝试重连
-                        logger.warning("检测到网络错误，30秒后重试...")
-                        time.sleep(30)
-                        
-                        # 重新初始化Supabase客户端
-                        try:
-                            logger.info("尝试重新连接Supabase...")
-                            self.setup_clients()
-                            logger.info("重新连接成功，继续处理...")
-                            current_reconnect_attempt = 0  # 重连成功后重置计数器
-                            continue
-                        except Exception as reconnect_error:
-                            logger.error(f"重连失败: {reconnect_error}")
-                            current_reconnect_attempt += 1
-                            if current_reconnect_attempt < max_reconnect_attempts:
-                                logger.warning(f"重连失败，{current_reconnect_attempt}/{max_reconnect_attempts} 次尝试...")
-                                time.sleep(60) # 重连失败后等待60秒
-                                continue
-                            else:
-                                logger.error(f"达到最大重连尝试次数 ({max_reconnect_attempts})，退出处理。")
-                                break
-                    else:
-                        # 真正没有更多数据
-                        logger.info("没有更多待处理记录")
-                        break
-                
-                logger.info(f"获取到 {len(records)} 条待处理记录")
-                
-                # 处理每条记录
-                for record in records:
-                    success = self.process_single_record(record)
-                    
-                    if success:
-                        processed_count += 1
-                        processed_ids.add(record['id'])
-                    else:
-                        failed_count += 1
-                    
-                    # 记录间的短暂延迟
-                    time.sleep(1)
-                
-                # 批次间的延迟
-                if len(records) == self.batch_size:
-                    logger.info("批次完成，等待5秒后继续...")
-                    time.sleep(5)
-                
+            pipeline.run()
         except KeyboardInterrupt:
             logger.info("用户中断处理")
+        except ConfigurationError as e:
+            logger.error(f"配置错误，停止处理: {e}")
         except Exception as e:
             logger.error(f"处理过程中出错: {e}")
         
         # 输出最终统计
-        logger.info(f"处理完成！成功: {processed_count}, 失败: {failed_count}")
+        stats = pipeline.get_stats()
+        failed_count = sum(stage['dropped'] for stage in stats.values())
+        logger.info(f"处理完成！成功: {stats['write']['processed']}, 失败: {failed_count}")
+        self.log_dead_letter_summary()
+        self.router.log_stats()
+        self.transport.log_stats()
 
 def main():
     """主函数"""
+    parser = argparse.ArgumentParser(description="绘本插图数据处理 - 稳定版本")
+    parser.add_argument('--retry-dead-letters', action='store_true',
+                        help="只重试死信队列中的失败记录")
+    parser.add_argument('--max-attempts', type=int, default=5,
+                        help="死信记录最多重试次数（默认5）")
+    parser.add_argument('--allow-fallback', action='store_true',
+                        help="AI分析失败时写入备用分析文本，而不是写入死信队列")
+    parser.add_argument('--analyze-workers', type=int, default=2,
+                        help="并行调用GPT分析的线程数（默认2）")
+    parser.add_argument('--queue-size', type=int, default=10,
+                        help="各处理阶段之间队列的容量（默认10）")
+    parser.add_argument('--profile', action='store_true',
+                        help="记录每条记录各阶段耗时，输出Chrome Trace/Perfetto时间线")
+    parser.add_argument('--profile-cpu', action='store_true',
+                        help="配合--profile使用，采样CPU调用栈")
+    parser.add_argument('--profile-alloc', action='store_true',
+                        help="配合--profile使用，统计内存分配")
+    parser.add_argument('--profile-output', default=f"profile_{datetime.now():%Y%m%d_%H%M%S}",
+                        help="剖析结果文件前缀")
+    args = parser.parse_args()
+    
+    profile_session = None
+    if args.profile:
+        profile_session = ProfileSession(args.profile_output, cpu=args.profile_cpu, alloc=args.profile_alloc)
+        profile_session.start()
+    
+    processor = None
     try:
-        processor = StableIllustrationProcessor()
+        processor = StableIllustrationProcessor(
+            allow_fallback=args.allow_fallback,
+            tracer=profile_session.tracer if profile_session else None,
+            analyze_workers=args.analyze_workers,
+            queue_size=args.queue_size
+        )
+        
+        if args.retry_dead_letters:
+            processor.retry_dead_letters(max_attempts=args.max_attempts)
+            return
         
         # 询问是否强制更新
         force_update = input("是否强制更新所有记录？(y/N): ").lower().strip() == 'y'
@@ -407,6 +699,11 @@ def main():
         
     except Exception as e:
         logger.error(f"程序启动失败: {e}")
+    finally:
+        if processor:
+            processor.transport.close()
+        if profile_session:
+            profile_session.stop()
 
 if __name__ == "__main__":
     main()
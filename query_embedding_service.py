@@ -0,0 +1,405 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+查询向量服务
+功能：为前端搜索提供查询文本的向量嵌入，内存+磁盘两级LRU缓存，
+      相同查询并发时合并为一次请求，不同查询的缓存未命中在短时间窗口内合并为一次批量嵌入调用
+作者：AI Assistant
+"""
+
+import re
+import json
+import time
+import queue
+import sqlite3
+import hashlib
+import logging
+import argparse
+import threading
+from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+
+import openai
+
+from clients import HttpTransport, load_client_settings, create_openai_client, EMBEDDING_MODEL, EMBEDDING_MAX_TOKENS
+
+# 配置日志
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s',
+    handlers=[
+        logging.FileHandler('query_embedding_service.log', encoding='utf-8'),
+        logging.StreamHandler()
+    ]
+)
+logger = logging.getLogger(__name__)
+
+# 请求体上限：8191个token的文本经JSON转义后也远小于该值
+MAX_BODY_BYTES = 256 * 1024
+
+
+def _load_encoder():
+    """加载嵌入模型使用的tiktoken编码器，未安装时返回None"""
+    try:
+        import tiktoken
+        return tiktoken.get_encoding('cl100k_base')  # text-embedding-3系列使用的编码
+    except Exception:
+        return None
+
+
+def _is_item_error(error: Exception) -> bool:
+    """是否为某一条输入引起的4xx错误；认证、模型不存在和限流与输入无关，逐条重试没有意义"""
+    return (isinstance(error, openai.APIStatusError)
+            and 400 <= error.status_code < 500
+            and error.status_code not in (401, 403, 404, 429))
+
+
+class EmbeddingCache:
+    """两级LRU缓存：内存中保存最近使用的向量，SQLite中保存更大范围的历史查询
+
+    向量以float32数组保存（1536维约6KB），对余弦相似度的影响可以忽略。
+    内存和磁盘各用一把锁，内存命中不会等待SQLite写入；磁盘命中的last_used延迟到下次写入时批量更新。
+    """
+
+    def __init__(self, path: str = 'query_embeddings.db', memory_size: int = 2000, disk_size: int = 50000):
+        self.memory_size = memory_size
+        self.disk_size = disk_size
+        self._memory: 'OrderedDict[str, array]' = OrderedDict()
+        self._memory_lock = threading.Lock()
+        self._disk_lock = threading.Lock()
+        self._touched: Dict[str, float] = {}  # 待写回的磁盘命中时间
+        self._puts_since_evict = 0
+
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS query_embeddings (
+                cache_key TEXT PRIMARY KEY,
+                vector BLOB NOT NULL,
+                last_used REAL NOT NULL
+            )
+        ''')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS idx_query_embeddings_last_used ON query_embeddings (last_used)')
+        self._conn.commit()
+
+    def get(self, key: str) -> Tuple[Optional[array], Optional[str]]:
+        """查找缓存，返回 (向量, 来源)，来源为 'memory' 或 'disk'"""
+        with self._memory_lock:
+            vector = self._memory.get(key)
+            if vector is not None:
+                self._memory.move_to_end(key)
+                return vector, 'memory'
+
+        with self._disk_lock:
+            row = self._conn.execute(
+                'SELECT vector FROM query_embeddings WHERE cache_key = ?', (key,)
+            ).fetchone()
+            if row is None:
+                return None, None
+            self._touched[key] = time.time()
+
+        vector = array('f', row[0])
+        with self._memory_lock:
+            self._remember(key, vector)
+        return vector, 'disk'
+
+    def put_many(self, items: List[Tuple[str, array]]):
+        """写入两级缓存，一批向量只提交一次"""
+        with self._memory_lock:
+            for key, vector in items:
+                self._remember(key, vector)
+
+        now = time.time()
+        with self._disk_lock:
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO query_embeddings (cache_key, vector, last_used) VALUES (?, ?, ?)',
+                [(key, vector.tobytes(), now) for key, vector in items]
+            )
+            self._flush_touched()
+            self._puts_since_evict += len(items)
+            if self._puts_since_evict >= 100:
+                self._evict_disk()
+            self._conn.commit()
+
+    def _remember(self, key: str, vector: array):
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_size:
+            self._memory.popitem(last=False)
+
+    def _flush_touched(self):
+        # 调用方持有磁盘锁
+        if self._touched:
+            self._conn.executemany(
+                'UPDATE query_embeddings SET last_used = ? WHERE cache_key = ?',
+                [(last_used, key) for key, last_used in self._touched.items()]
+            )
+            self._touched = {}
+
+    def _evict_disk(self):
+        # 每写入一批后清理最久未使用的磁盘缓存
+        self._puts_since_evict = 0
+        self._conn.execute('''
+            DELETE FROM query_embeddings WHERE cache_key IN (
+                SELECT cache_key FROM query_embeddings ORDER BY last_used DESC LIMIT -1 OFFSET ?
+            )
+        ''', (self.disk_size,))
+
+    def close(self):
+        with self._disk_lock:
+            self._flush_touched()
+            self._conn.commit()
+            self._conn.close()
+
+
+class QueryEmbedder:
+    """带缓存、请求合并和微批处理的查询向量生成器"""
+
+    def __init__(self, cache: EmbeddingCache, max_batch: int = 64, batch_wait: float = 0.01):
+        """
+        Args:
+            cache: 两级向量缓存
+            max_batch: 单次嵌入调用最多包含的查询数
+            batch_wait: 收到第一个未命中查询后，等待更多查询加入批次的时间（秒）
+        """
+        self.settings = load_client_settings(require_supabase=False)
+        self.transport = HttpTransport()
+        self.openai_client = create_openai_client(self.settings, self.transport)
+        self.cache = cache
+        self.max_batch = max_batch
+        self.batch_wait = batch_wait
+        self._encoder = _load_encoder()
+
+        self._pending: 'queue.Queue[Tuple[str, str, Future]]' = queue.Queue()
+        self._inflight: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=1000)
+        self._metrics = {
+            'requests': 0,
+            'memory_hits': 0,
+            'disk_hits': 0,
+            'coalesced': 0,
+            'misses': 0,
+            'batches': 0,
+            'batched_texts': 0,
+            'split_batches': 0,
+            'errors': 0,
+        }
+
+        self._batcher = threading.Thread(target=self._batch_loop, name='embedding-batcher', daemon=True)
+        self._batcher.start()
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        """规范化查询文本，使仅空白不同的查询共用缓存"""
+        return re.sub(r'\s+', ' ', text).strip()
+
+    def count_tokens(self, text: str) -> int:
+        """计算文本token数；未安装tiktoken时按UTF-8字节数计，每个token至少1个字节，不会低估"""
+        if self._encoder is not None:
+            return len(self._encoder.encode(text))
+        return len(text.encode('utf-8'))
+
+    @staticmethod
+    def cache_key(text: str) -> str:
+        return hashlib.sha256(f"{EMBEDDING_MODEL}\0{text}".encode('utf-8')).hexdigest()
+
+    def embed(self, text: str, timeout: float = 30.0) -> Tuple[array, str]:
+        """获取查询向量，返回 (向量, 来源)，来源为 memory / disk / coalesced / api"""
+        started = time.perf_counter()
+        text = self.normalize(text)
+        if not text:
+            raise ValueError("查询文本不能为空")
+        if self.count_tokens(text) > EMBEDDING_MAX_TOKENS:
+            raise ValueError(f"查询文本超过模型上限 {EMBEDDING_MAX_TOKENS} 个token")
+        key = self.cache_key(text)
+
+        vector, source = self.cache.get(key)
+        if vector is None:
+            with self._lock:
+                future = self._inflight.get(key)
+                if future is not None:
+                    source = 'coalesced'
+                else:
+                    source = 'api'
+                    future = Future()
+                    self._inflight[key] = future
+                    self._pending.put((key, text, future))
+            try:
+                vector = future.result(timeout=timeout)
+            except Exception:
+                self._count('errors')
+                raise
+
+        self._count({'memory': 'memory_hits', 'disk': 'disk_hits', 'coalesced': 'coalesced', 'api': 'misses'}[source])
+        with self._lock:
+            self._metrics['requests'] += 1
+            self._latencies.append(time.perf_counter() - started)
+        return vector, source
+
+    def get_metrics(self) -> Dict:
+        """获取命中率和延迟统计"""
+        with self._lock:
+            metrics = dict(self._metrics)
+            latencies = sorted(self._latencies)
+        requests = metrics['requests']
+        metrics['hit_rate'] = (metrics['memory_hits'] + metrics['disk_hits']) / requests if requests else 0.0
+        metrics['avg_batch_size'] = metrics['batched_texts'] / metrics['batches'] if metrics['batches'] else 0.0
+        metrics['p50_latency_ms'] = latencies[len(latencies) // 2] * 1000 if latencies else 0.0
+        metrics['p95_latency_ms'] = latencies[int(len(latencies) * 0.95)] * 1000 if latencies else 0.0
+        metrics['connection_pools'] = self.transport.get_stats()
+        return metrics
+
+    def _count(self, name: str):
+        with self._lock:
+            self._metrics[name] += 1
+
+    def _batch_loop(self):
+        while True:
+            batch = [self._pending.get()]
+            deadline = time.monotonic() + self.batch_wait
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._pending.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._embed_batch(batch)
+
+    def _embed_batch(self, batch: List[Tuple[str, str, Future]]):
+        try:
+            self._request(batch)
+        except Exception as e:
+            if len(batch) > 1 and _is_item_error(e):
+                # 一条输入有问题会让整批失败，逐条重试，只让有问题的查询失败
+                logger.warning(f"批量生成查询向量失败 ({len(batch)}个)，逐条重试: {e}")
+                with self._lock:
+                    self._metrics['split_batches'] += 1
+                for item in batch:
+                    try:
+                        self._request([item])
+                    except Exception as item_error:
+                        logger.error(f"生成查询向量失败: {item_error}")
+                        item[2].set_exception(item_error)
+            else:
+                logger.error(f"批量生成查询向量失败 ({len(batch)}个): {e}")
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+        finally:
+            with self._lock:
+                for key, _, _ in batch:
+                    self._inflight.pop(key, None)
+                self._metrics['batches'] += 1
+                self._metrics['batched_texts'] += len(batch)
+
+    def _request(self, batch: List[Tuple[str, str, Future]]):
+        """调用嵌入接口，写入缓存并完成对应的Future"""
+        response = self.openai_client.embeddings.create(
+            model=EMBEDDING_MODEL,
+            input=[text for _, text, _ in batch],
+            encoding_format="float",
+            timeout=30
+        )
+        vectors = [array('f', item.embedding) for item in sorted(response.data, key=lambda item: item.index)]
+        self.cache.put_many([(key, vector) for (key, _, _), vector in zip(batch, vectors)])
+        for (_, _, future), vector in zip(batch, vectors):
+            future.set_result(vector)
+
+
+class QueryEmbeddingHandler(BaseHTTPRequestHandler):
+    """HTTP接口：POST /embed、GET /metrics、GET /health"""
+
+    embedder: QueryEmbedder = None
+
+    def do_OPTIONS(self):
+        self._send_json(204, None)
+
+    def do_GET(self):
+        if self.path == '/metrics':
+            self._send_json(200, self.embedder.get_metrics())
+        elif self.path == '/health':
+            self._send_json(200, {'status': 'ok'})
+        else:
+            self._send_json(404, {'error': 'not found'})
+
+    def do_POST(self):
+        if self.path != '/embed':
+            self._send_json(404, {'error': 'not found'})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            if length < 0:
+                raise ValueError
+        except ValueError:
+            self._send_json(400, {'error': "Content-Length无效"})
+            return
+        if length > MAX_BODY_BYTES:
+            # 不读取请求体，直接关闭连接
+            self.close_connection = True
+            self._send_json(413, {'error': f"请求体超过 {MAX_BODY_BYTES} 字节"})
+            return
+        try:
+            payload = json.loads(self.rfile.read(length) or b'{}')
+            vector, source = self.embedder.embed(str(payload.get('text', '')))
+        except (ValueError, openai.BadRequestError) as e:
+            self._send_json(400, {'error': str(e)})
+            return
+        except Exception as e:
+            self._send_json(502, {'error': f"向量化失败: {e}"})
+            return
+        self._send_json(200, {
+            'embedding': vector.tolist(),
+            'dimension': len(vector),
+            'model': EMBEDDING_MODEL,
+            'source': source,
+        })
+
+    def _send_json(self, status: int, body: Optional[Dict]):
+        data = json.dumps(body, ensure_ascii=False).encode('utf-8') if body is not None else b''
+        self.send_response(status)
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
+        self.send_header('Access-Control-Allow-Headers', 'Content-Type')
+        if body is not None:
+            self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+def main():
+    """主函数"""
+    parser = argparse.ArgumentParser(description="查询向量服务")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--cache-path', default='query_embeddings.db', help="磁盘缓存文件")
+    parser.add_argument('--memory-size', type=int, default=2000, help="内存缓存条数")
+    parser.add_argument('--disk-size', type=int, default=50000, help="磁盘缓存条数")
+    parser.add_argument('--batch-wait-ms', type=float, default=10, help="微批等待时间（毫秒）")
+    args = parser.parse_args()
+
+    cache = EmbeddingCache(args.cache_path, memory_size=args.memory_size, disk_size=args.disk_size)
+    QueryEmbeddingHandler.embedder = QueryEmbedder(cache, batch_wait=args.batch_wait_ms / 1000)
+
+    server = ThreadingHTTPServer((args.host, args.port), QueryEmbeddingHandler)
+    logger.info(f"查询向量服务已启动: http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info("服务停止")
+    finally:
+        server.server_close()
+        logger.info(f"服务统计: {json.dumps(QueryEmbeddingHandler.embedder.get_metrics(), ensure_ascii=False)}")
+        cache.close()
+
+
+if __name__ == "__main__":
+    main()
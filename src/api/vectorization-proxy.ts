@@ -23,6 +23,30 @@ export interface VectorizationResponse {
   model: string;
 }
 
+// 查询向量服务地址（query_embedding_service.py），未配置时直接调用OpenAI
+const QUERY_EMBEDDING_URL: string | undefined = import.meta.env.VITE_QUERY_EMBEDDING_URL;
+
+/**
+ * 通过查询向量服务获取向量（服务端带LRU缓存和请求合并）
+ * @param text 要向量化的文本
+ * @returns 向量化结果
+ */
+async function vectorizeWithService(text: string): Promise<number[]> {
+  const response = await fetch(`${QUERY_EMBEDDING_URL!.replace(/\/$/, '')}/embed`, {
+    method: 'POST',
+    headers: { 'Content-Type': 'application/json' },
+    body: JSON.stringify({ text }),
+  });
+  
+  if (!response.ok) {
+    throw new Error(`查询向量服务返回 ${response.status}`);
+  }
+  
+  const result: { embedding: number[]; source: string } = await response.json();
+  console.log(`✅ 向量化完成: ${result.embedding.length}维 (来源: ${result.source})`);
+  return result.embedding;
+}
+
 /**
  * 通过OpenAI API进行文本向量化
  * @param text 要向量化的文本
@@ -33,6 +57,15 @@ export async function vectorizeText(text: string, model: string = 'text-embeddin
   try {
     console.log('📝 向量化文本:', text.substring(0, 50) + '...');
     
+    // 配置了查询向量服务时优先使用（带缓存），失败时回退到直接调用OpenAI
+    if (QUERY_EMBEDDING_URL && model === 'text-embedding-3-small') {
+      try {
+        return await vectorizeWithService(text);
+      } catch (serviceError) {
+        console.warn('⚠️ 查询向量服务不可用，直接调用OpenAI:', serviceError);
+      }
+    }
+    
     // 使用真实的OpenAI API
     const response = await openai.embeddings.create({
       model: model,
@@ -3,6 +3,7 @@
 interface ImportMetaEnv {
   readonly VITE_OPENAI_API_KEY: string
   readonly VITE_OPENAI_BASE_URL: string
+  readonly VITE_QUERY_EMBEDDING_URL?: string
 }
 
 interface ImportMeta {
@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+处理流程追踪与性能剖析
+功能：按阶段记录每条记录的耗时区间，输出Chrome Trace / Perfetto可直接打开的JSON时间线；
+      可选采样CPU调用栈（火焰图folded格式）和内存分配统计（tracemalloc）
+作者：AI Assistant
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+import threading
+import tracemalloc
+from collections import Counter
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class _NullSpan:
+    """关闭追踪时使用的空区间，不做任何记录"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    """一个计时区间，退出时写入追踪事件"""
+
+    __slots__ = ('tracer', 'name', 'args', 'start')
+
+    def __init__(self, tracer: 'Tracer', name: str, args: Dict):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.args['error'] = exc_type.__name__
+        self.tracer.add_event(self.name, self.start, time.perf_counter(), self.args)
+        return False
+
+
+class Tracer:
+    """阶段耗时追踪器
+
+    关闭时span()直接返回共享的空区间，开销只有一次属性判断。
+    """
+
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self._origin = time.perf_counter()
+        self._pid = os.getpid()
+        self._events = []
+        self._thread_names: Dict[int, str] = {}
+
+    def span(self, name: str, **args):
+        """记录一个阶段区间，用法：with tracer.span('chat', record_id=...)"""
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name, args)
+
+    def add_event(self, name: str, start: float, end: float, args: Optional[Dict] = None):
+        """写入一个完整区间事件（Chrome Trace 'X' 事件，时间单位为微秒）"""
+        thread = threading.current_thread()
+        self._thread_names.setdefault(thread.ident, thread.name)
+        # list.append在GIL下是原子操作，多线程阶段可直接写入
+        self._events.append({
+            'name': name,
+            'ph': 'X',
+            'ts': (start - self._origin) * 1e6,
+            'dur': (end - start) * 1e6,
+            'pid': self._pid,
+            'tid': thread.ident,
+            'args': args or {},
+        })
+
+    def counter(self, name: str, values: Dict[str, float]):
+        """记录计数器事件（Chrome Trace 'C' 事件），如各队列的占用数"""
+        if not self.enabled:
+            return
+        self._events.append({
+            'name': name,
+            'ph': 'C',
+            'ts': (time.perf_counter() - self._origin) * 1e6,
+            'pid': self._pid,
+            'args': values,
+        })
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        """按阶段汇总次数与总耗时（秒）"""
+        totals: Dict[str, Dict[str, float]] = {}
+        for event in self._events:
+            if event['ph'] != 'X':
+                continue
+            stage = totals.setdefault(event['name'], {'count': 0, 'seconds': 0.0})
+            stage['count'] += 1
+            stage['seconds'] += event['dur'] / 1e6
+        return totals
+
+    def save(self, path: str):
+        """保存为Chrome Trace格式，可在 chrome://tracing 或 ui.perfetto.dev 打开"""
+        metadata = [
+            {'name': 'thread_name', 'ph': 'M', 'pid': self._pid, 'tid': tid, 'args': {'name': name}}
+            for tid, name in self._thread_names.items()
+        ]
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'traceEvents': metadata + self._events, 'displayTimeUnit': 'ms'}, f)
+        logger.info(f"追踪时间线已保存: {path} ({len(self._events)}个事件)")
+
+
+# 停在这些函数中的线程视为空闲，不计入采样
+_IDLE_FRAMES = {
+    ('threading.py', 'wait'),
+    ('threading.py', '_wait_for_tstate_lock'),
+    ('queue.py', 'get'),
+    ('queue.py', 'put'),
+    ('selectors.py', 'select'),
+    ('socket.py', 'readinto'),
+    ('ssl.py', 'read'),
+    ('ssl.py', 'recv_into'),
+}
+
+
+def _thread_cpu_time(thread_id: int) -> Optional[float]:
+    """读取指定线程已消耗的CPU时间（秒），平台不支持或线程已退出时返回None"""
+    try:
+        return time.clock_gettime(time.pthread_getcpuclockid(thread_id))
+    except (AttributeError, OSError):
+        return None
+
+
+class CpuSampler(threading.Thread):
+    """采样式CPU剖析器
+
+    后台线程按固定间隔抓取其他线程的调用栈，汇总为火焰图工具（flamegraph.pl、speedscope）
+    可读取的folded格式。停在等待函数（队列、锁、socket读取）中的线程直接跳过；
+    其余样本按该线程两次采样之间实际消耗的CPU时间（微秒）计数，阻塞在sleep或C扩展里的线程
+    不会计入。没有线程CPU时钟的平台（如Windows）按采样间隔计数。
+    """
+
+    def __init__(self, interval: float = 0.01):
+        super().__init__(name='cpu-sampler', daemon=True)
+        self.interval = interval
+        self.samples: Counter = Counter()
+        self._stop_event = threading.Event()
+        self._last_cpu: Dict[int, float] = {}
+
+    def run(self):
+        own_ident = threading.get_ident()
+        while not self._stop_event.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_ident:
+                    continue
+                weight = self._weight(thread_id, frame)
+                if weight <= 0:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                self.samples[';'.join(reversed(stack))] += weight
+
+    def _weight(self, thread_id: int, frame) -> int:
+        cpu_time = _thread_cpu_time(thread_id)
+        last_cpu = None
+        if cpu_time is not None:
+            # 第一次看到的线程没有基准，只记录当前CPU时间
+            last_cpu = self._last_cpu.get(thread_id, cpu_time)
+            self._last_cpu[thread_id] = cpu_time
+
+        code = frame.f_code
+        if (os.path.basename(code.co_filename), code.co_name) in _IDLE_FRAMES:
+            return 0
+        if cpu_time is None:
+            return int(self.interval * 1e6)
+        return int((cpu_time - last_cpu) * 1e6)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+    def save(self, path: str):
+        with open(path, 'w', encoding='utf-8') as f:
+            for stack, count in self.samples.most_common():
+                f.write(f"{stack} {count}\n")
+        logger.info(f"CPU采样已保存: {path} (共{sum(self.samples.values()) / 1e6:.2f}秒CPU时间)")
+
+
+class ProfileSession:
+    """一次处理运行的剖析会话，统一管理追踪、CPU采样和内存分配统计"""
+
+    def __init__(self, output_prefix: str, cpu: bool = False, alloc: bool = False):
+        self.output_prefix = output_prefix
+        self.tracer = Tracer(enabled=True)
+        self.cpu_sampler = CpuSampler() if cpu else None
+        self.alloc = alloc
+
+    def start(self):
+        if self.cpu_sampler:
+            self.cpu_sampler.start()
+        if self.alloc:
+            tracemalloc.start(25)
+        logger.info(f"性能剖析已开启，输出前缀: {self.output_prefix}")
+
+    def stop(self):
+        """停止剖析并写出所有结果文件"""
+        self.tracer.save(f"{self.output_prefix}.trace.json")
+        for name, stage in sorted(self.tracer.summary().items(), key=lambda item: -item[1]['seconds']):
+            logger.info(f"阶段 {name}: {stage['count']}次, 共{stage['seconds']:.2f}秒")
+
+        if self.cpu_sampler:
+            self.cpu_sampler.stop()
+            self.cpu_sampler.save(f"{self.output_prefix}.cpu.folded")
+
+        if self.alloc:
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            path = f"{self.output_prefix}.alloc.txt"
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(f"当前内存: {current / 1024 / 1024:.1f} MiB, 峰值: {peak / 1024 / 1024:.1f} MiB\n\n")
+                for stat in snapshot.statistics('lineno')[:50]:
+                    f.write(f"{stat}\n")
+            logger.info(f"内存分配统计已保存: {path}")
@@ -0,0 +1,490 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+向量索引参数调优工具
+功能：在本地加载导出的7个主题向量，按参数网格构建HNSW/IVF索引，
+      测量构建时间、内存、查询延迟以及相对精确搜索的recall@k，输出每个字段的推荐参数和对应SQL；
+      推荐参数需同时让加权搜索（各字段候选并集重排）相对精确加权搜索的recall@k达到目标
+作者：AI Assistant
+
+用法：
+    python tune_ann_indexes.py --export vectors.npz        # 从Supabase导出向量
+    python tune_ann_indexes.py vectors.npz                 # 调优并生成报告和SQL
+
+依赖：numpy；HNSW调优需要hnswlib（未安装时只评估IVF）
+"""
+
+import os
+import json
+import time
+import sqlite3
+import logging
+import argparse
+import tempfile
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+# 配置日志
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s',
+    handlers=[
+        logging.FileHandler('ann_tuning.log', encoding='utf-8'),
+        logging.StreamHandler()
+    ]
+)
+logger = logging.getLogger(__name__)
+
+THEME_FIELDS = [
+    'theme_philosophy',
+    'action_process',
+    'interpersonal_roles',
+    'edu_value',
+    'learning_strategy',
+    'creative_play',
+    'scene_visuals'
+]
+
+# 与 weighted_semantic_search_optimized 的默认权重一致
+DEFAULT_WEIGHTS = {
+    'theme_philosophy': 0.14,
+    'action_process': 0.14,
+    'interpersonal_roles': 0.14,
+    'edu_value': 0.14,
+    'learning_strategy': 0.14,
+    'creative_play': 0.14,
+    'scene_visuals': 0.16,
+}
+
+HNSW_GRID = {
+    'm': [8, 16, 24, 32],
+    'ef_construction': [32, 64, 128, 200],
+    'ef_search': [20, 40, 80, 160],
+}
+
+# optimize_weighted_search_performance.sql 中当前使用的HNSW参数
+CURRENT_HNSW = {'m': 16, 'ef_construction': 64}
+
+
+def export_vectors(path: str, page_size: int = 200):
+    """从Supabase分页导出7个主题向量，保存为npz
+
+    每行向量到达后立即转为float32数组，内存占用约为 行数 × 7 × 6KB，而不是数十倍的Python浮点数列表。
+    """
+    from clients import HttpTransport, load_client_settings, create_supabase_client
+
+    supabase = create_supabase_client(load_client_settings(), HttpTransport())
+    columns = ', '.join(['id'] + [f"{field}_embedding" for field in THEME_FIELDS])
+
+    ids: List[str] = []
+    vectors: Dict[str, List[Optional[np.ndarray]]] = {field: [] for field in THEME_FIELDS}
+    last_id = None
+    while True:
+        query = supabase.table('illustrations_optimized').select(columns).order('id').limit(page_size)
+        if last_id is not None:
+            query = query.gt('id', last_id)
+        rows = query.execute().data
+        if not rows:
+            break
+        for row in rows:
+            ids.append(row['id'])
+            for field in THEME_FIELDS:
+                value = row.get(f"{field}_embedding")
+                # PostgREST以字符串形式返回vector类型
+                if isinstance(value, str):
+                    value = json.loads(value)
+                vectors[field].append(np.asarray(value, dtype=np.float32) if value else None)
+        last_id = rows[-1]['id']
+        logger.info(f"已导出 {len(ids)} 条记录")
+
+    dimension = next((len(v) for field in THEME_FIELDS for v in vectors[field] if v is not None), 1536)
+    arrays = {}
+    for field in THEME_FIELDS:
+        data = np.zeros((len(ids), dimension), dtype=np.float32)
+        mask = np.zeros(len(ids), dtype=bool)
+        for i, value in enumerate(vectors[field]):
+            if value is not None:
+                data[i] = value
+                mask[i] = True
+        vectors[field] = []  # 逐字段释放
+        arrays[field] = data
+        arrays[f"{field}_mask"] = mask
+    np.savez_compressed(path, ids=np.array(ids), **arrays)
+    logger.info(f"向量已导出到 {path}")
+
+
+def load_vectors(path: str) -> Tuple[np.ndarray, Dict[str, np.ndarray], Dict[str, np.ndarray]]:
+    """加载导出的向量并归一化，返回 (ids, 各字段向量, 各字段有效掩码)"""
+    data = np.load(path)
+    vectors, masks = {}, {}
+    for field in THEME_FIELDS:
+        matrix = data[field].astype(np.float32)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        vectors[field] = matrix / norms
+        masks[field] = data[f"{field}_mask"]
+    return data['ids'], vectors, masks
+
+
+def load_queries(vectors: Dict[str, np.ndarray], masks: Dict[str, np.ndarray],
+                 count: int, query_cache: Optional[str], seed: int) -> np.ndarray:
+    """准备查询向量
+
+    优先使用查询向量服务缓存（query_embeddings.db）中的真实查询；
+    没有时从已有主题向量中随机抽样并加入少量噪声，模拟与库内内容相近的查询。
+    """
+    rng = np.random.default_rng(seed)
+    if query_cache and os.path.exists(query_cache):
+        conn = sqlite3.connect(query_cache)
+        rows = conn.execute('SELECT vector FROM query_embeddings ORDER BY last_used DESC LIMIT ?', (count,)).fetchall()
+        conn.close()
+        if rows:
+            queries = np.stack([np.frombuffer(row[0], dtype=np.float32) for row in rows])
+            logger.info(f"使用查询缓存中的 {len(queries)} 条真实查询")
+            return queries / np.linalg.norm(queries, axis=1, keepdims=True)
+
+    samples = []
+    for _ in range(count):
+        field = THEME_FIELDS[rng.integers(len(THEME_FIELDS))]
+        candidates = np.flatnonzero(masks[field])
+        vector = vectors[field][rng.choice(candidates)]
+        samples.append(vector + rng.normal(0, 0.02, vector.shape).astype(np.float32))
+    queries = np.stack(samples)
+    logger.info(f"从库内向量抽样生成 {len(queries)} 条查询")
+    return queries / np.linalg.norm(queries, axis=1, keepdims=True)
+
+
+def exact_top_k(matrix: np.ndarray, queries: np.ndarray, k: int) -> np.ndarray:
+    """精确余弦相似度top-k（向量已归一化）"""
+    scores = queries @ matrix.T
+    k = min(k, matrix.shape[0])
+    top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    order = np.argsort(-np.take_along_axis(scores, top, axis=1), axis=1)
+    return np.take_along_axis(top, order, axis=1)
+
+
+def exact_weighted_top_k(vectors: Dict[str, np.ndarray], masks: Dict[str, np.ndarray],
+                         queries: np.ndarray, weights: Dict[str, float], k: int) -> np.ndarray:
+    """与数据库加权搜索相同的精确加权打分top-k"""
+    total = np.zeros((queries.shape[0], len(next(iter(masks.values())))), dtype=np.float32)
+    for field in THEME_FIELDS:
+        total += weights[field] * (queries @ vectors[field].T) * masks[field]
+    top = np.argpartition(-total, k - 1, axis=1)[:, :k]
+    order = np.argsort(-np.take_along_axis(total, top, axis=1), axis=1)
+    return np.take_along_axis(top, order, axis=1)
+
+
+def recall_at_k(found: np.ndarray, truth: np.ndarray) -> float:
+    hits = sum(len(set(f) & set(t)) for f, t in zip(found, truth))
+    return hits / truth.size
+
+
+def measure_queries(search, queries: np.ndarray) -> Tuple[np.ndarray, float, float]:
+    """逐条执行查询，返回 (结果, 平均延迟ms, P95延迟ms)"""
+    results, latencies = [], []
+    for query in queries:
+        started = time.perf_counter()
+        results.append(search(query))
+        latencies.append((time.perf_counter() - started) * 1000)
+    latencies.sort()
+    return np.array(results), float(np.mean(latencies)), latencies[int(len(latencies) * 0.95)]
+
+
+def tune_hnsw(matrix: np.ndarray, queries: np.ndarray, truth: np.ndarray, k: int) -> List[Dict]:
+    """按HNSW_GRID构建hnswlib索引并评估"""
+    import hnswlib
+
+    results = []
+    for m in HNSW_GRID['m']:
+        for ef_construction in HNSW_GRID['ef_construction']:
+            index = hnswlib.Index(space='cosine', dim=matrix.shape[1])
+            started = time.perf_counter()
+            index.init_index(max_elements=matrix.shape[0], M=m, ef_construction=ef_construction, random_seed=42)
+            index.add_items(matrix, np.arange(matrix.shape[0]), num_threads=1)
+            build_seconds = time.perf_counter() - started
+
+            with tempfile.NamedTemporaryFile(suffix='.bin', delete=False) as f:
+                index_path = f.name
+            index.save_index(index_path)
+            memory_mb = os.path.getsize(index_path) / 1024 / 1024
+            os.remove(index_path)
+
+            index.set_num_threads(1)
+            for ef_search in HNSW_GRID['ef_search']:
+                index.set_ef(max(ef_search, k))
+                found, avg_ms, p95_ms = measure_queries(
+                    lambda q: index.knn_query(q, k=k)[0][0], queries
+                )
+                results.append({
+                    'type': 'hnsw',
+                    'params': {'m': m, 'ef_construction': ef_construction, 'ef_search': ef_search},
+                    'build_seconds': build_seconds,
+                    'memory_mb': memory_mb,
+                    'avg_latency_ms': avg_ms,
+                    'p95_latency_ms': p95_ms,
+                    'recall': recall_at_k(found, truth),
+                    'found': found,
+                })
+    return results
+
+
+def spherical_kmeans(matrix: np.ndarray, lists: int, iterations: int, rng) -> Tuple[np.ndarray, np.ndarray]:
+    """球面k-means，对应pgvector ivfflat的聚类方式"""
+    centroids = matrix[rng.choice(matrix.shape[0], lists, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = np.argmax(matrix @ centroids.T, axis=1)
+        for c in range(lists):
+            members = matrix[assignment == c]
+            if len(members):
+                centroid = members.sum(axis=0)
+                centroids[c] = centroid / (np.linalg.norm(centroid) or 1.0)
+    return centroids, np.argmax(matrix @ centroids.T, axis=1)
+
+
+def tune_ivf(matrix: np.ndarray, queries: np.ndarray, truth: np.ndarray, k: int, seed: int) -> List[Dict]:
+    """按pgvector建议的lists范围构建IVF索引并评估"""
+    rows = matrix.shape[0]
+    base = max(rows // 1000, int(np.sqrt(rows)) // 2, 1)
+    list_options = sorted({max(1, min(rows, value)) for value in [base, base * 2, base * 4]})
+    rng = np.random.default_rng(seed)
+
+    results = []
+    for lists in list_options:
+        started = time.perf_counter()
+        centroids, assignment = spherical_kmeans(matrix, lists, iterations=10, rng=rng)
+        inverted = [np.flatnonzero(assignment == c) for c in range(lists)]
+        build_seconds = time.perf_counter() - started
+        memory_mb = (matrix.nbytes + centroids.nbytes + assignment.size * 8) / 1024 / 1024
+
+        probe_options = sorted({1, max(1, int(np.sqrt(lists))), max(1, lists // 4), max(1, lists // 2)})
+        for probes in probe_options:
+            def search(query, probes=probes):
+                nearest_lists = np.argpartition(-(centroids @ query), probes - 1)[:probes]
+                candidates = np.concatenate([inverted[c] for c in nearest_lists])
+                if len(candidates) == 0:
+                    return np.full(k, -1)
+                scores = matrix[candidates] @ query
+                top = candidates[np.argsort(-scores)[:k]]
+                return np.pad(top, (0, k - len(top)), constant_values=-1)
+
+            found, avg_ms, p95_ms = measure_queries(search, queries)
+            results.append({
+                'type': 'ivfflat',
+                'params': {'lists': lists, 'probes': probes},
+                'build_seconds': build_seconds,
+                'memory_mb': memory_mb,
+                'avg_latency_ms': avg_ms,
+                'p95_latency_ms': p95_ms,
+                'recall': recall_at_k(found, truth),
+                'found': found,
+            })
+    return results
+
+
+def recommend(results: List[Dict], target_recall: float, index_type: str,
+              latency_tolerance: float = 0.1) -> Dict:
+    """在同一种索引的配置中选择推荐参数
+
+    hnswlib和numpy实现的IVF延迟不可比，只在同类型内比较。达到目标召回率的配置中，
+    延迟在最快配置的 (1 + latency_tolerance) 倍以内的视为相同，从中选内存和构建时间最小的，
+    避免计时噪声决定结果；都达不到目标时选择召回率最高的。
+    """
+    results = [r for r in results if r['type'] == index_type]
+    qualified = [r for r in results if r['recall'] >= target_recall]
+    if not qualified:
+        return max(results, key=lambda r: (r['recall'], -r['avg_latency_ms']))
+    fastest = min(r['avg_latency_ms'] for r in qualified)
+    close = [r for r in qualified if r['avg_latency_ms'] <= fastest * (1 + latency_tolerance)]
+    return min(close, key=lambda r: (r['memory_mb'], r['build_seconds'], r['avg_latency_ms']))
+
+
+def is_current_hnsw(result: Dict) -> bool:
+    """是否与当前索引的构建参数相同"""
+    return result['type'] == 'hnsw' and all(result['params'][key] == value for key, value in CURRENT_HNSW.items())
+
+
+def weighted_candidate_recall(vectors: Dict[str, np.ndarray], masks: Dict[str, np.ndarray],
+                              row_maps: Dict[str, np.ndarray], queries: np.ndarray,
+                              weights: Dict[str, float], k: int, truth: np.ndarray,
+                              per_field_found: Dict[str, np.ndarray]) -> float:
+    """用各字段ANN结果的并集作为候选，按精确加权分重排，计算相对精确加权搜索的recall@k"""
+    found = []
+    for qi, query in enumerate(queries):
+        candidates = set()
+        for field in THEME_FIELDS:
+            positions = per_field_found[field][qi]
+            candidates.update(row_maps[field][positions[positions >= 0]].tolist())
+        candidates = np.array(sorted(candidates))
+        scores = np.zeros(len(candidates), dtype=np.float32)
+        for field in THEME_FIELDS:
+            scores += weights[field] * (vectors[field][candidates] @ query) * masks[field][candidates]
+        found.append(candidates[np.argsort(-scores)[:k]])
+    hits = sum(len(set(f.tolist()) & set(t.tolist())) for f, t in zip(found, truth))
+    return hits / truth.size
+
+
+def build_sql(recommendations: Dict[str, Dict]) -> str:
+    """生成应用推荐参数的SQL；构建参数与当前索引相同的字段不重建"""
+    lines = [
+        '-- 由 tune_ann_indexes.py 生成的向量索引参数',
+        '-- CREATE INDEX CONCURRENTLY 不能在事务或DO块中执行，请逐条运行',
+        '',
+    ]
+    ef_search = 0
+    probes = 0
+    for field, best in recommendations.items():
+        column = f"{field}_embedding"
+        lines.append(f"-- {field}: recall@k {best['recall']:.3f}, 平均延迟 {best['avg_latency_ms']:.2f}ms")
+        if is_current_hnsw(best):
+            ef_search = max(ef_search, best['params']['ef_search'])
+            lines.append(f"-- 推荐参数与当前索引相同 (m = {CURRENT_HNSW['m']}, "
+                         f"ef_construction = {CURRENT_HNSW['ef_construction']})，无需重建")
+            lines.append('')
+            continue
+        params = best['params']
+        if best['type'] == 'hnsw':
+            ef_search = max(ef_search, params['ef_search'])
+            method, options = 'hnsw', f"m = {params['m']}, ef_construction = {params['ef_construction']}"
+        else:
+            probes = max(probes, params['probes'])
+            method, options = 'ivfflat', f"lists = {params['lists']}"
+
+        # 先用临时名称建好新索引再删除旧索引，重建期间该列始终有索引可用
+        index_name = f"idx_{column}_{method}"
+        lines.append(f"DROP INDEX CONCURRENTLY IF EXISTS {index_name}_new;  -- 清理上次中断留下的无效索引")
+        lines.append(
+            f"CREATE INDEX CONCURRENTLY {index_name}_new\n"
+            f"ON illustrations_optimized\n"
+            f"USING {method} ({column} vector_cosine_ops)\n"
+            f"WITH ({options});"
+        )
+        for index_type in ['hnsw', 'ivfflat']:
+            lines.append(f"DROP INDEX CONCURRENTLY IF EXISTS idx_{column}_{index_type};")
+        lines.append(f"ALTER INDEX {index_name}_new RENAME TO {index_name};")
+        lines.append('')
+
+    # ef_search / probes 是会话级参数，取各字段推荐值的最大值
+    if ef_search:
+        lines.append(f"ALTER DATABASE postgres SET hnsw.ef_search = {ef_search};")
+    if probes:
+        lines.append(f"ALTER DATABASE postgres SET ivfflat.probes = {probes};")
+    return '\n'.join(lines) + '\n'
+
+
+def main():
+    """主函数"""
+    parser = argparse.ArgumentParser(description="向量索引参数调优")
+    parser.add_argument('vectors', nargs='?', default='vectors.npz', help="导出的向量文件（npz）")
+    parser.add_argument('--export', action='store_true', help="从Supabase导出向量到指定文件后退出")
+    parser.add_argument('--k', type=int, default=20, help="recall@k中的k，默认与match_count一致")
+    parser.add_argument('--queries', type=int, default=200, help="评估查询数")
+    parser.add_argument('--query-cache', default='query_embeddings.db', help="查询向量服务的缓存文件")
+    parser.add_argument('--target-recall', type=float, default=0.95)
+    parser.add_argument('--latency-tolerance', type=float, default=0.1,
+                        help="延迟相差在该比例内的配置视为相同，优先选内存和构建时间小的")
+    parser.add_argument('--index-type', choices=['hnsw', 'ivfflat'],
+                        help="推荐的索引类型，默认有hnswlib时为hnsw，否则为ivfflat")
+    parser.add_argument('--skip-ivf', action='store_true')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--report', default='ann_tuning_report.json')
+    parser.add_argument('--sql', default='ann_tuning_indexes.sql')
+    args = parser.parse_args()
+
+    if args.export:
+        export_vectors(args.vectors)
+        return
+
+    try:
+        import hnswlib  # noqa: F401
+        has_hnswlib = True
+    except ImportError:
+        has_hnswlib = False
+        logger.warning("未安装hnswlib，跳过HNSW评估（pip install hnswlib）")
+    if not has_hnswlib and args.skip_ivf:
+        logger.error("没有可评估的索引类型")
+        return
+    index_type = args.index_type or ('hnsw' if has_hnswlib else 'ivfflat')
+    if (index_type == 'hnsw' and not has_hnswlib) or (index_type == 'ivfflat' and args.skip_ivf):
+        logger.error(f"无法评估推荐的索引类型 {index_type}")
+        return
+
+    ids, vectors, masks = load_vectors(args.vectors)
+    queries = load_queries(vectors, masks, args.queries, args.query_cache, args.seed)
+    logger.info(f"加载 {len(ids)} 条记录, 查询 {len(queries)} 条, k={args.k}")
+
+    report = {'records': int(len(ids)), 'queries': int(len(queries)), 'k': args.k, 'fields': {}}
+    field_results: Dict[str, List[Dict]] = {}
+    row_maps: Dict[str, np.ndarray] = {}
+
+    for field in THEME_FIELDS:
+        row_map = np.flatnonzero(masks[field])
+        matrix = vectors[field][row_map]
+        if len(matrix) <= args.k:
+            logger.warning(f"{field} 有效向量不足 {args.k} 条，跳过")
+            continue
+        row_maps[field] = row_map
+        truth = exact_top_k(matrix, queries, args.k)
+
+        results = []
+        if has_hnswlib:
+            results += tune_hnsw(matrix, queries, truth, args.k)
+        if not args.skip_ivf:
+            results += tune_ivf(matrix, queries, truth, args.k, args.seed)
+        field_results[field] = results
+        report['fields'][field] = {'vectors': int(len(matrix)), 'results': results}
+
+        # 记录当前默认配置作为对照
+        baseline = [r for r in results if is_current_hnsw(r)]
+        if baseline:
+            report['fields'][field]['current_default'] = baseline
+
+    def recommend_all(field_target: float) -> Dict[str, Dict]:
+        return {
+            field: recommend(results, field_target, index_type, args.latency_tolerance)
+            for field, results in field_results.items()
+        }
+
+    # 先按各字段的recall@k选择；7个字段齐全时再用加权搜索的recall@k检验，
+    # 达不到目标就逐步提高各字段的召回要求，直到加权搜索达标或各字段已取召回率最高的配置
+    field_target = args.target_recall
+    recommendations = recommend_all(field_target)
+    if len(field_results) == len(THEME_FIELDS):
+        weighted_truth = exact_weighted_top_k(vectors, masks, queries, DEFAULT_WEIGHTS, args.k)
+        while True:
+            weighted_recall = weighted_candidate_recall(
+                vectors, masks, row_maps, queries, DEFAULT_WEIGHTS, args.k, weighted_truth,
+                {field: best['found'] for field, best in recommendations.items()}
+            )
+            logger.info(f"各字段召回要求 {field_target:.2f} 时，加权搜索 recall@{args.k}: {weighted_recall:.3f}")
+            if weighted_recall >= args.target_recall or field_target >= 1.0:
+                break
+            field_target = min(1.0, round(field_target + 0.01, 2))
+            recommendations = recommend_all(field_target)
+        report['weighted_recall'] = weighted_recall
+        report['field_target_recall'] = field_target
+        if weighted_recall < args.target_recall:
+            logger.warning(f"加权搜索 recall@{args.k} 未达到目标 {args.target_recall}，"
+                           f"各字段top-{args.k}的并集本身不足以覆盖加权搜索的结果")
+    else:
+        logger.warning("部分字段缺少向量，只按各字段的recall@k推荐")
+
+    for field, best in recommendations.items():
+        report['fields'][field]['recommended'] = best
+        logger.info(
+            f"{field}: 推荐 {best['type']} {best['params']}, recall {best['recall']:.3f}, "
+            f"平均 {best['avg_latency_ms']:.2f}ms, 构建 {best['build_seconds']:.1f}s, 内存 {best['memory_mb']:.1f}MB"
+        )
+    for results in field_results.values():
+        for result in results:
+            del result['found']
+
+    with open(args.report, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    with open(args.sql, 'w', encoding='utf-8') as f:
+        f.write(build_sql(recommendations))
+    logger.info(f"报告已保存: {args.report}, SQL已保存: {args.sql}")
+
+
+if __name__ == "__main__":
+    main()